@@ -0,0 +1,182 @@
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import io
+import json
+import os
+import platform
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime
+from optparse import OptionParser
+from pathlib import Path
+
+from _SyntheticCorpus import CorpusSpec, FORMATS, generate_corpus
+from _ePubMaker import EPubMaker
+
+# the phases and steps shown in the report, the profile contains more
+REPORTED_PHASES = ["make_tree", "scan", "decode", "resize", "encode", "write_image", "render_page", "write_templates"]
+
+
+def make_scenarios(base: CorpusSpec):
+    """
+    :return: the corpus spec and the options of the EPubMaker of every scenario by name
+    """
+    width, height = base.width, base.height
+    return {
+        "passthrough": (base, {}),
+        "resize": (base, {"max_width": width // 2, "max_height": height // 2}),
+        "grayscale": (base, {"grayscale": True}),
+        "resize-grayscale": (base, {"max_width": width // 2, "max_height": height // 2, "grayscale": True}),
+        "mixed-formats": (base._replace(formats=tuple(FORMATS)), {"max_width": width // 2}),
+        "deep-tree": (base._replace(depth=4, chapters=3), {}),
+        "no-wrap": (base, {"wrap_pages": False}),
+    }
+
+
+def run_scenario(name, spec: CorpusSpec, maker_options, work_dir: Path, repeat=1):
+    """
+    Make an ePub of the corpus of the spec, and return the measurements of the fastest run.
+    """
+    corpus = generate_corpus(spec, work_dir.joinpath("corpora"))
+    bytes_in = sum(path.stat().st_size for path in corpus.rglob("*") if path.suffix in (".jpg", ".png", ".gif"))
+    best = None
+    for _ in range(repeat):
+        prefix = work_dir.joinpath("profiles", name)
+        prefix.parent.mkdir(parents=True, exist_ok=True)
+        output = work_dir.joinpath("output", name + ".epub")
+        output.parent.mkdir(parents=True, exist_ok=True)
+        options = dict(grayscale=False, max_width=None, max_height=None, wrap_pages=True)
+        options.update(maker_options)
+        maker = EPubMaker(master=None, input_dir=str(corpus), file=str(output), name=name, profile=prefix, **options)
+        with redirect_stdout(io.StringIO()):
+            maker.run()
+        if maker.error:
+            raise maker.error
+        with open(str(prefix) + ".json", encoding='utf-8') as file:
+            profile = json.load(file)
+        wall = profile["wall"]
+        result = {
+            "corpus": spec.name, "options": dict(maker_options),
+            "pages": spec.pages, "wall": wall, "pages_per_second": spec.pages / wall,
+            "mb_per_second": bytes_in / 1024 / 1024 / wall, "bytes_in": bytes_in,
+            "bytes_out": output.stat().st_size,
+            "phases": {phase: profile["phases"].get(phase, {"wall": 0.0})["wall"] for phase in REPORTED_PHASES},
+        }
+        if best is None or result["wall"] < best["wall"]:
+            best = result
+    return best
+
+
+def print_results(results, baseline=None):
+    print(f"{'Scenario':<18} {'Pages/s':>9} {'MB/s':>8} {'Wall':>8}  " + " ".join(
+        f"{phase[:11]:>11}" for phase in REPORTED_PHASES) + ("  vs baseline" if baseline else ""))
+    for name, result in results.items():
+        line = (
+            f"{name:<18} {result['pages_per_second']:>9.1f} {result['mb_per_second']:>8.1f} {result['wall']:>7.2f}s  "
+            + " ".join(f"{result['phases'][phase]:>10.2f}s" for phase in REPORTED_PHASES)
+        )
+        old = (baseline or {}).get(name)
+        if old:
+            line += f"  {result['pages_per_second'] / old['pages_per_second']:>10.2f}x"
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options] [SCENARIO ...]')
+    parser.add_option(
+        '-n', '--pages', dest='pages', default=50, type="int", help="The number of pages per corpus. (Default: %default)"
+    )
+    parser.add_option(
+        '--width', dest='width', default=1600, type="int", help="The width of the pages. (Default: %default)"
+    )
+    parser.add_option(
+        '--height', dest='height', default=2400, type="int", help="The height of the pages. (Default: %default)"
+    )
+    parser.add_option(
+        '--formats', dest='formats', default="jpeg",
+        help="Comma separated formats of the pages, of jpeg, png, and gif. (Default: %default)"
+    )
+    parser.add_option(
+        '--depth', dest='depth', default=1, type="int", help="The number of levels of chapters. (Default: %default)"
+    )
+    parser.add_option(
+        '--chapters', dest='chapters', default=4, type="int",
+        help="The number of chapters in every level. (Default: %default)"
+    )
+    parser.add_option(
+        '--gray-source', dest='gray_source', default=False, action='store_true',
+        help="Generate grayscale instead of color pages."
+    )
+    parser.add_option(
+        '-j', '--jobs', dest='jobs', default=1, type="int", metavar='N',
+        help="Transcode the images with N worker processes. (Default: %default)"
+    )
+    parser.add_option(
+        '-r', '--repeat', dest='repeat', default=1, type="int",
+        help="Run every scenario this many times and keep the fastest run. (Default: %default)"
+    )
+    parser.add_option(
+        '-w', '--work-dir', dest='work_dir', default=os.path.join(tempfile.gettempdir(), "images_to_epub_benchmark"),
+        metavar='DIRECTORY', help="DIRECTORY for the corpora and the output. (Default: %default)"
+    )
+    parser.add_option(
+        '-o', '--output', dest='output', default=None, metavar='FILE', help="Store the results in FILE."
+    )
+    parser.add_option(
+        '-c', '--compare', dest='compare', default=None, metavar='FILE',
+        help="Compare the results with the results stored in FILE."
+    )
+    parser.add_option(
+        '-l', '--list', dest='list', default=False, action='store_true', help="List the scenarios."
+    )
+    (options, args) = parser.parse_args()
+
+    formats = tuple(options.formats.split(","))
+    if not set(formats).issubset(FORMATS):
+        parser.error(f"The formats should be one or more of {', '.join(FORMATS)}")
+    scenarios = make_scenarios(CorpusSpec(
+        pages=options.pages, width=options.width, height=options.height, formats=formats, depth=options.depth,
+        chapters=options.chapters, color=not options.gray_source,
+    ))
+    if options.list:
+        for scenario_name, (scenario_spec, scenario_options) in scenarios.items():
+            print(f"{scenario_name:<18} {scenario_spec.name} {scenario_options}")
+        parser.exit()
+    unknown = [name for name in args if name not in scenarios]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+
+    results = {}
+    for scenario_name in args or scenarios:
+        scenario_spec, scenario_options = scenarios[scenario_name]
+        results[scenario_name] = run_scenario(
+            scenario_name, scenario_spec, dict(scenario_options, jobs=options.jobs), Path(options.work_dir),
+            options.repeat
+        )
+
+    baseline_results = None
+    if options.compare:
+        with open(options.compare, encoding='utf-8') as baseline_file:
+            baseline_results = json.load(baseline_file)["results"]
+    print_results(results, baseline_results)
+
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as output_file:
+            json.dump({
+                "date": datetime.now().isoformat(), "python": platform.python_version(), "machine": platform.machine(),
+                "cpus": os.cpu_count(), "jobs": options.jobs, "results": results,
+            }, output_file, indent=1)
@@ -14,16 +14,30 @@
     You should have received a copy of the GNU Affero General Public License
     along with this program.  If not, see [http://www.gnu.org/licenses/]
 """
+import contextlib
 import os
+import sys
 from optparse import OptionParser
 from pathlib import Path
 
-from _ePubMaker import EPubMaker, CmdProgress
+from _ePubMaker import EPubMaker, CmdProgress, RESAMPLE_FILTERS, DEFAULT_RESAMPLE, DEFAULT_REDUCING_GAP
+from _Compression import DEFAULT_LEVEL
+from _Crop import DEFAULT_MARGIN, DEFAULT_TOLERANCE
+from _EInk import DEFAULT_GAMMA
+from _Options import DEFAULT_QUEUE_SIZE, DEFAULT_SETTLE, DEFAULT_WORKERS, check_maker_options
+from _Profiles import OUTPUT_FORMATS, DEVICE_PROFILES, device_options
+from _TranscodeCache import DEFAULT_CACHE_SIZE
+
+# the file name that stands for standard output
+STDOUT_FILE = "-"
 
 if __name__ == '__main__':
     parser = OptionParser(
         usage='usage: %prog [--cmd] [--progress] --dir DIRECTORY --file FILE --name NAME\n'
-              '   or: %prog [--progress] DIRECTORY DIRECTORY ... (batchmode, implies -c)'
+              '   or: %prog [--cmd] [--progress] --dir DIRECTORY --update FILE --name NAME\n'
+              '   or: %prog [--progress] DIRECTORY DIRECTORY ... (batchmode, implies -c)\n'
+              '   or: %prog --watch DIRECTORY DIRECTORY ... (batchmode, keeps the ePubs up to date)\n'
+              '   or: %prog --serve PORT (makes ePubs for requests to a local HTTP API)'
     )
     parser.add_option(
         '-c', '--cmd', action='store_true', dest='cmd', default=False, help='Start without gui'
@@ -33,10 +47,12 @@ if __name__ == '__main__':
         help='Show a nice progressbar (cmd only)'
     )
     parser.add_option(
-        '-d', '--dir', dest='input_dir', metavar='DIRECTORY', help='DIRECTORY with the images'
+        '-d', '--dir', dest='input_dir', metavar='DIRECTORY',
+        help='DIRECTORY with the images, or a zip (cbz) or tar archive with the images'
     )
     parser.add_option(
-        '-f', '--file', dest='file', metavar='FILE', help='FILE where the ePub is stored'
+        '-f', '--file', dest='file', metavar='FILE',
+        help="FILE where the ePub is stored, or - to write it to standard output, like a pipe, with --cmd"
     )
     parser.add_option(
         '-n', '--name', dest='name', default='', metavar='NAME', help='NAME of the book'
@@ -53,6 +69,55 @@ if __name__ == '__main__':
         '-H', '--max-height', dest='max_height', default=None, type="int",
         help="Resize all images to have the given maximum height in pixels."
     )
+    parser.add_option(
+        '--resize-filter', dest='resample', default=DEFAULT_RESAMPLE, type="choice", choices=list(RESAMPLE_FILTERS),
+        help=f"The filter used to resize images, one of {', '.join(RESAMPLE_FILTERS)}. (Default: %default)"
+    )
+    parser.add_option(
+        '--reducing-gap', dest='reducing_gap', default=DEFAULT_REDUCING_GAP, type="float",
+        help="Resize images in multiple steps, first reducing them by an integer factor as long as they stay this many "
+             "times larger than the final size. Lower is faster, 0 disables it. (Default: %default)"
+    )
+    parser.add_option(
+        '--device', dest='device', default=None, type="choice", choices=list(DEVICE_PROFILES), metavar='DEVICE',
+        help=f"Use the resolution, colors, format, and page budget of a device, one of {', '.join(DEVICE_PROFILES)}. "
+             f"The other options override those of the device."
+    )
+    parser.add_option(
+        '--format', dest='output_format', default=None, type="choice", choices=list(OUTPUT_FORMATS),
+        metavar='FORMAT', help=f"Convert all images to FORMAT, one of {', '.join(OUTPUT_FORMATS)}."
+    )
+    parser.add_option(
+        '--page-kb', dest='page_kb', default=None, type="int", metavar='KB',
+        help="Lower the JPEG quality of every page until it fits in KB kilobytes, as long as it still looks like the "
+             "image."
+    )
+    parser.add_option(
+        '--book-mb', dest='book_mb', default=None, type="int", metavar='MB',
+        help="Divide a budget of MB megabytes over the pages of the book, like --page-kb."
+    )
+    parser.add_option(
+        '--also', dest='also', default=[], action='append', metavar='DEVICE:FILE',
+        help="Also make the ePub for DEVICE in FILE, in the same pass, so every image is decoded once for all "
+             "ePubs. Can be given multiple times. Implies -c."
+    )
+    parser.add_option(
+        '--eink', dest='eink', default=None, type="choice", choices=list(OUTPUT_FORMATS), metavar='FORMAT',
+        help="Turn all images into the 16 levels of gray of e-ink screens, saved as 4 bit png or grayscale jpeg. "
+             "Needs NumPy."
+    )
+    parser.add_option(
+        '--gamma', dest='gamma', default=DEFAULT_GAMMA, type="float",
+        help="The gamma of e-ink images, above 1 makes the midtones brighter. (Default: %default)"
+    )
+    parser.add_option(
+        '--levels', dest='levels', default="0,255", metavar='BLACK,WHITE',
+        help="Make the gray levels of e-ink images up to BLACK black and from WHITE white. (Default: %default)"
+    )
+    parser.add_option(
+        '--dither', dest='dither', default=False, action='store_true',
+        help="Dither e-ink images, so gradients do not turn into bands."
+    )
     parser.add_option(
         '--wrap-pages', dest='wrap_pages', action='store_true',
         help="Wrap the pages in a separate file. Results will vary for each reader. (Default)"
@@ -61,46 +126,288 @@ if __name__ == '__main__':
         '--no-wrap-pages', dest='no_wrap_pages', action='store_true',
         help="Do not wrap the pages in a separate file. Results will vary for each reader."
     )
+    parser.add_option(
+        '-j', '--jobs', dest='jobs', default=1, type="int", metavar='N',
+        help="Transcode the images with N worker processes. Use 0 to use all cores. (Default: 1)"
+    )
+    parser.add_option(
+        '--cache', dest='cache_dir', default=None, metavar='DIRECTORY',
+        help="Store the resized and converted images in DIRECTORY, so later runs can reuse them."
+    )
+    parser.add_option(
+        '--cache-size', dest='cache_size', default=DEFAULT_CACHE_SIZE // 1024 // 1024, type="int", metavar='MB',
+        help="Maximum size of the cache in megabytes. The least recently used images are removed first. "
+             "(Default: %default)"
+    )
+    parser.add_option(
+        '-u', '--update', dest='update', default=None, metavar='FILE',
+        help="Update the ePub FILE made by this program. Only new and changed images are converted again. "
+             "The result is stored in FILE unless '--file' is given."
+    )
+    parser.add_option(
+        '--index', dest='index_file', default=None, metavar='FILE',
+        help="Store the sizes and types of the images in FILE, so later runs only read the headers of changed images."
+    )
+    parser.add_option(
+        '--compress-level', dest='compression_level', default=DEFAULT_LEVEL, type="int", metavar='LEVEL',
+        help="The DEFLATE LEVEL (0-9) of the pages and tables of contents. JPEG, PNG, and GIF images are stored "
+             "without compressing them again. (Default: %default)"
+    )
+    parser.add_option(
+        '--compress-sample', dest='compression_sample', default=False, action='store_true',
+        help="Compress a sample of every image to decide whether compressing it is worth it."
+    )
+    parser.add_option(
+        '--books', dest='books', default=1, type="int", metavar='N',
+        help="Make N books at the same time in batchmode. The jobs are divided over the books. (Default: 1)"
+    )
+    parser.add_option(
+        '--memory-limit', dest='memory_limit', default=None, type="int", metavar='MB',
+        help="Only start another book in batchmode if the estimated memory use stays below MB megabytes."
+    )
+    parser.add_option(
+        '--force', dest='force', default=False, action='store_true',
+        help="Make all books in batchmode, also the ones of which the images and options did not change."
+    )
+    parser.add_option(
+        '--profile', dest='profile', default=None, metavar='PREFIX',
+        help="Write the time spent per phase and per page to PREFIX.json and a Chrome trace to PREFIX.trace.json."
+    )
+    parser.add_option(
+        '--dedup', dest='dedup', default=False, action='store_true',
+        help="Store images with exactly the same content only once. Requires wrapped pages."
+    )
+    parser.add_option(
+        '--dedup-threshold', dest='dedup_threshold', default=None, type="int", metavar='BITS',
+        help="Also store images only once if their perceptual hashes differ in at most BITS of 64 bits. Implies "
+             "--dedup."
+    )
+    parser.add_option(
+        '--prefetch', dest='prefetch', default=0, type="int", metavar='MB',
+        help="Read the images ahead on background threads, keeping at most MB megabytes in memory. Helps when the "
+             "images are on a network filesystem. (Default: %default, disabled)"
+    )
+    parser.add_option(
+        '--split-size', dest='split_size', default=None, type="int", metavar='MB',
+        help="Split the book in volumes of at most MB megabytes, preferably at the start of a chapter. The volumes "
+             "are named FILE - Volume N.epub."
+    )
+    parser.add_option(
+        '--split-pages', dest='split_pages', default=None, type="int", metavar='N',
+        help="Split the book in volumes of at most N pages, preferably at the start of a chapter."
+    )
+    parser.add_option(
+        '--crop', dest='crop', default=False, action='store_true',
+        help="Crop the white or black margins of the pages before they are resized, so the content fills the screen. "
+             "Needs NumPy."
+    )
+    parser.add_option(
+        '--crop-tolerance', dest='crop_tolerance', default=DEFAULT_TOLERANCE, type="int", metavar='LEVEL',
+        help="The number of gray levels a pixel may differ from the border and still be part of the margin, which "
+             "allows for noise. (Default: %default)"
+    )
+    parser.add_option(
+        '--crop-margin', dest='crop_margin', default=DEFAULT_MARGIN, type="float", metavar='PERCENT',
+        help="The margin that is kept around the content, in percent of the page. (Default: %default)"
+    )
+    parser.add_option(
+        '--crop-spreads', dest='crop_spreads', default=False, action='store_true',
+        help="Crop facing pages the same, so the pages of a spread still line up."
+    )
+    parser.add_option(
+        '--strips', dest='strips', default=False, action='store_true',
+        help="Cut images that are at least two pages tall, like the chapters of webtoons, in pages at rows without "
+             "content. PNG strips are decoded in bands, so they use little memory however tall they are."
+    )
+    parser.add_option(
+        '--dry-run', dest='dry_run', default=False, action='store_true',
+        help="Only print the chapters, the pages that would be resized or made grayscale, and the estimated size and "
+             "time of the ePubs, from the headers of the images. Implies -c."
+    )
+    parser.add_option(
+        '--checkpoint', dest='checkpoint', default=False, action='store_true',
+        help="Keep the finished pages when making an ePub is interrupted, and continue from them when it is made again "
+             "with the same settings. Not used with --update, --split-size and --split-pages."
+    )
+    parser.add_option(
+        '--progress-json', dest='progress_json', default=None, metavar='FILE',
+        help="Append the progress, like the phases and the time and size of every page, as JSON lines to FILE."
+    )
+    parser.add_option(
+        '--watch', dest='watch', default=False, action='store_true',
+        help="Keep watching the directories in batchmode, and update the ePub of a directory when its images change."
+    )
+    parser.add_option(
+        '--settle', dest='settle', default=DEFAULT_SETTLE, type="float", metavar='SECONDS',
+        help="Update the ePub of a watched directory when it did not change for SECONDS. (Default: %default)"
+    )
+    parser.add_option(
+        '--poll', dest='poll', default=None, type="float", metavar='SECONDS',
+        help="Look for changes of the watched directories every SECONDS instead of using inotify."
+    )
+    parser.add_option(
+        '--serve', dest='serve', default=None, type="int", metavar='PORT',
+        help="Make ePubs for requests to an HTTP API on localhost:PORT. The other options are the defaults of the jobs."
+    )
+    parser.add_option(
+        '--workers', dest='workers', default=DEFAULT_WORKERS, type="int", metavar='N',
+        help="Make N ePubs at the same time when serving. (Default: %default)"
+    )
+    parser.add_option(
+        '--queue', dest='queue', default=DEFAULT_QUEUE_SIZE, type="int", metavar='N',
+        help="Refuse new jobs when serving if N jobs are waiting. (Default: %default)"
+    )
     (options, args) = parser.parse_args()
+    options.reducing_gap = options.reducing_gap or None
+    if options.device:
+        device = device_options(options.device)
+        options.max_width = options.max_width or device["max_width"]
+        options.max_height = options.max_height or device["max_height"]
+        options.grayscale = options.grayscale or device["grayscale"]
+        options.output_format = options.output_format or device["output_format"]
+        page_bytes = options.page_kb * 1024 if options.page_kb else device["page_bytes"]
+        book_bytes = options.book_mb * 1024 * 1024 if options.book_mb else device["book_bytes"]
+    else:
+        page_bytes = options.page_kb and options.page_kb * 1024
+        book_bytes = options.book_mb and options.book_mb * 1024 * 1024
+    try:
+        options.black_point, options.white_point = (int(level) for level in options.levels.split(","))
+    except ValueError:
+        parser.error("option --levels must be two numbers like 16,240")
+    options.file = options.file or options.update
+    # options that are passed as-is to the EPubMaker, and are not shown in the gui
+    maker_options = dict(
+        jobs=options.jobs, cache_dir=options.cache_dir, cache_size=options.cache_size * 1024 * 1024,
+        index_file=options.index_file, compression_level=options.compression_level,
+        compression_sample=options.compression_sample, profile=options.profile, dedup=options.dedup,
+        dedup_threshold=options.dedup_threshold, prefetch=options.prefetch * 1024 * 1024,
+        progress_json=options.progress_json, split_size=options.split_size and options.split_size * 1024 * 1024,
+        split_pages=options.split_pages, checkpoint=options.checkpoint, eink=options.eink, gamma=options.gamma,
+        black_point=options.black_point, white_point=options.white_point, dither=options.dither,
+        output_format=options.output_format, page_bytes=page_bytes, book_bytes=book_bytes, strips=options.strips,
+        crop=options.crop, crop_tolerance=options.crop_tolerance, crop_margin=options.crop_margin,
+        crop_spreads=options.crop_spreads,
+    )
 
     if options.wrap_pages and options.no_wrap_pages:
         parser.error("options --wrap-pages and --no-wrap-pages are mutually exclusive")
+    if (options.page_kb is not None and options.page_kb < 1) or (options.book_mb is not None and options.book_mb < 1):
+        parser.error("options --page-kb and --book-mb must be at least 1")
+    try:
+        check_maker_options(dict(
+            maker_options, max_width=options.max_width, max_height=options.max_height,
+            reducing_gap=options.reducing_gap, wrap_pages=not options.no_wrap_pages,
+        ))
+    except ValueError as e:
+        parser.error(str(e))
+    also = []
+    for target in options.also:
+        device, _, file = target.partition(":")
+        if device not in DEVICE_PROFILES or not file:
+            parser.error(f"option --also must be DEVICE:FILE with DEVICE one of {', '.join(DEVICE_PROFILES)}")
+        also.append((device, file))
+    if also and not (options.input_dir and options.file and options.name) or also and options.dry_run:
+        parser.error("option --also only works with --dir, --file, and --name, and not with --dry-run")
+    if also and options.strips:
+        parser.error("option --also can not be used with --strips")
+    if options.dry_run and (options.watch or options.serve is not None):
+        parser.error("option --dry-run can not be used with --watch or --serve")
+    if options.watch and (options.input_dir or options.file or options.name):
+        parser.error("option --watch only works in batchmode")
+    if options.poll is not None and options.poll <= 0:
+        parser.error("option --poll must be more than 0")
+    if options.file == STDOUT_FILE and not (options.cmd or options.dry_run):
+        parser.error("option --file - only works with --cmd")
+    if options.file == STDOUT_FILE and (also or options.split_size or options.split_pages or options.checkpoint):
+        parser.error("option --file - can not be used with --also, --split-size, --split-pages, or --checkpoint")
+    if (options.split_size or options.split_pages) and options.update:
+        parser.error("option --update can not be used with --split-size or --split-pages")
+
+    if options.serve is not None:
+        if args or options.input_dir or options.file or options.name:
+            parser.error("option --serve does not take directories")
+        if options.workers < 1 or options.queue < 1:
+            parser.error("options --workers and --queue must be at least 1")
+        from _Server import serve
 
-    if not options.input_dir and not options.file and not options.name:
+        serve(options.serve, dict(
+            grayscale=options.grayscale, max_width=options.max_width, max_height=options.max_height,
+            resample=options.resample, reducing_gap=options.reducing_gap, wrap_pages=not options.no_wrap_pages,
+            **maker_options
+        ), workers=options.workers, queue_size=options.queue)
+    elif not options.input_dir and not options.file and not options.name:
         if not all(os.path.isdir(elem) for elem in args):
             parser.error("Not all given arguments are directories!")
 
         directories = []
         for elem in args:
-            path = Path(args)
+            path = Path(elem)
             if not path.is_dir():
                 parser.error(f"The following path is not a directory: {path}")
             if not path.name:
                 parser.error(f"Could not get the name of the directory: {path}")
             directories.append(path)
 
-        for path in directories:
-            EPubMaker(
-                master=None, input_dir=path, file=path.parent.joinpath(path.name + '.epub'), name=path.name or "Output",
-                grayscale=options.grayscale, max_width=options.max_width, max_height=options.max_height,
-                progress=CmdProgress(options.progress), wrap_pages=not options.no_wrap_pages
-            ).run()
+        batch_options = dict(
+            grayscale=options.grayscale, max_width=options.max_width, max_height=options.max_height,
+            resample=options.resample, reducing_gap=options.reducing_gap, wrap_pages=not options.no_wrap_pages,
+            **maker_options
+        )
+        scheduler_options = dict(
+            books=options.books, memory_limit=options.memory_limit and options.memory_limit * 1024 * 1024,
+            progress=options.progress,
+        )
+        if options.dry_run:
+            from _BatchScheduler import BatchScheduler
+
+            BatchScheduler(directories, batch_options, force=options.force, **scheduler_options).dry_run()
+        elif options.watch:
+            from _Watcher import Watcher
+
+            Watcher(
+                directories, batch_options, settle=options.settle, poll_interval=options.poll, **scheduler_options
+            ).run(force=options.force)
+        else:
+            from _BatchScheduler import BatchScheduler
+
+            BatchScheduler(directories, batch_options, force=options.force, **scheduler_options).run()
     elif options.input_dir and options.file and options.name:
-        if options.cmd:
+        if options.cmd or options.dry_run or also:
             if args or not options.input_dir or not options.file or not options.name:
                 parser.error("The '--dir', '--file', and '--name' arguments are required.")
 
-            EPubMaker(
-                master=None, input_dir=options.input_dir, file=options.file, name=options.name,
+            streamed = options.file == STDOUT_FILE and not options.dry_run
+            maker = EPubMaker(
+                master=None, input_dir=options.input_dir, file=sys.stdout.buffer if streamed else options.file,
+                name=options.name,
                 grayscale=options.grayscale, max_width=options.max_width,
-                max_height=options.max_height, progress=CmdProgress(options.progress),
-                wrap_pages=not options.no_wrap_pages
-            ).run()
+                max_height=options.max_height, resample=options.resample, reducing_gap=options.reducing_gap,
+                progress=CmdProgress(options.progress), wrap_pages=not options.no_wrap_pages, update=options.update,
+                **maker_options
+            )
+            if options.dry_run:
+                print(maker.plan())
+            elif also:
+                from _MultiMaker import MultiEPubMaker
+
+                makers = [maker] + [EPubMaker(
+                    master=None, input_dir=options.input_dir, file=file, name=options.name,
+                    resample=options.resample, reducing_gap=options.reducing_gap, wrap_pages=not options.no_wrap_pages,
+                    **dict(maker_options, profile=None, eink=None, **device_options(device))
+                ) for device, file in also]
+                MultiEPubMaker(makers, maker.jobs).run()
+            elif streamed:
+                # the messages go to standard error, so standard output only has the ePub
+                with contextlib.redirect_stdout(sys.stderr):
+                    maker.run()
+            else:
+                maker.run()
         else:
             import _Gui
 
             _Gui.start_gui(input_dir=options.input_dir, file=options.file, name=options.name,
                            grayscale=options.grayscale, max_width=options.max_width, max_height=options.max_height,
-                           wrap_pages=not options.no_wrap_pages)
+                           resample=options.resample, reducing_gap=options.reducing_gap,
+                           wrap_pages=not options.no_wrap_pages, update=options.update, **maker_options)
     else:
         parser.print_help()
@@ -0,0 +1,233 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from _Compression import format_size
+from _ImageIndex import ImageIndex
+from _Progress import format_duration
+from _ePubMaker import EPubMaker, CmdProgress, METADATA_VERSION, filter_images, read_metadata, volume_file
+
+# the number of copies of a decoded image that are in memory at the same time while transcoding it
+DECODE_COPIES = 3
+POLL_INTERVAL = 0.1
+# options that do not change the resulting ePub
+RUNTIME_OPTIONS = {"jobs", "cache_dir", "cache_size", "index_file", "progress", "profile", "prefetch", "progress_json",
+                   "checkpoint"}
+
+
+def list_images(directory):
+    """
+    :return: the path, size, and modification time of every image in the directory and its subdirectories
+    """
+    result = []
+    for dir_path, dir_names, filenames in os.walk(directory):
+        for filename, _, _ in filter_images(filenames):
+            source = os.path.join(dir_path, filename)
+            stat = os.stat(source)
+            result.append((source, stat.st_size, stat.st_mtime_ns))
+    result.sort()
+    return result
+
+
+def build_book(maker_options):
+    maker = EPubMaker(master=None, **maker_options)
+    maker.run()
+    sys.exit(1 if maker.error else 0)
+
+
+class Book:
+    def __init__(self, path: Path, split=False):
+        self.path = path
+        self.file = path.parent.joinpath(path.name + '.epub')
+        # whether the book is split in volumes, which are stored next to where the ePub would be
+        self.split = split
+        self.name = path.name or "Output"
+        self.status = "waiting"
+        self.metadata: Optional[dict] = None
+        self.fingerprint: Optional[str] = None
+        self.images = []
+        self.memory = 0
+        self.process: Optional[multiprocessing.Process] = None
+        self.start_time = 0.0
+        self.seconds = 0.0
+
+    def make_fingerprint(self, maker_options):
+        """
+        Combine the sizes and modification times of the images with the options, so a book is only made again when
+        one of them changed.
+        """
+        self.images = list_images(self.path)
+        options = sorted((key, value) for key, value in maker_options.items() if key not in RUNTIME_OPTIONS)
+        digest = hashlib.sha256(f"{METADATA_VERSION}:{options!r}".encode())
+        for source, size, mtime in self.images:
+            digest.update(f"{os.path.relpath(source, self.path)}:{size}:{mtime}\n".encode())
+        self.fingerprint = digest.hexdigest()
+
+    @property
+    def files(self) -> List[str]:
+        """
+        :return: the ePub of the book, or the volumes of the book if it is split in volumes, that exist
+        """
+        if not self.split:
+            return [str(self.file)] if os.path.isfile(self.file) else []
+        files = []
+        while os.path.isfile(volume_file(self.file, len(files) + 1)):
+            files.append(volume_file(self.file, len(files) + 1))
+        return files
+
+    def is_up_to_date(self) -> bool:
+        """
+        :return: whether the ePub or all volumes of the book were made from the same images and options
+        """
+        files = self.files
+        return bool(files) and all(
+            (read_metadata(file) or {}).get("fingerprint") == self.fingerprint for file in files)
+
+    @property
+    def size(self) -> Optional[int]:
+        files = self.files
+        return sum(os.path.getsize(file) for file in files) if files else None
+
+
+class BatchScheduler:
+    """
+    Makes the books of a batch, running multiple books at the same time. The worker processes given by the jobs of
+    the options are divided over the books that run at the same time, and a book is only started if its estimated
+    memory use fits in the memory limit. Books of which the images and options did not change since the last run are
+    skipped.
+    """
+
+    def __init__(self, directories: List[Path], maker_options: dict, books=1, memory_limit=None, force=False,
+                 progress=False):
+        self.books = [
+            Book(path, bool(maker_options.get("split_size") or maker_options.get("split_pages"))) for path in directories
+        ]
+        self.maker_options = maker_options
+        self.parallel_books = max(1, books)
+        self.memory_limit = memory_limit
+        self.force = force
+        self.progress = progress
+        jobs = maker_options.get("jobs", 1)
+        total_jobs = jobs if 0 < jobs else os.cpu_count() or 1
+        self.jobs_per_book = max(1, total_jobs // self.parallel_books)
+
+    def find_pending(self) -> List[Book]:
+        """
+        :return: the books that should be made, the others are marked as skipped
+        """
+        pending = []
+        for book in self.books:
+            book.make_fingerprint(self.maker_options)
+            # a book that is split in volumes is made anew, as volumes can not be updated
+            book.metadata = None if book.split else read_metadata(book.file)
+            if not self.force and book.is_up_to_date():
+                book.status = "skipped"
+            else:
+                pending.append(book)
+        return pending
+
+    def run(self):
+        pending = self.find_pending()
+        if self.memory_limit:
+            self.estimate_memory(pending)
+
+        running = []
+        while pending or running:
+            while pending and len(running) < self.parallel_books and self.fits_in_memory(pending[0], running):
+                book = pending.pop(0)
+                self.start(book)
+                running.append(book)
+            time.sleep(POLL_INTERVAL)
+            for book in running[:]:
+                if not book.process.is_alive():
+                    book.process.join()
+                    book.seconds = time.perf_counter() - book.start_time
+                    book.status = "created" if book.process.exitcode == 0 else "failed"
+                    running.remove(book)
+        self.print_summary()
+
+    def fits_in_memory(self, book: Book, running: List[Book]) -> bool:
+        """
+        A book that does not fit in the memory limit on its own is started when no other book is running.
+        """
+        if not self.memory_limit or not running:
+            return True
+        return sum(other.memory for other in running) + book.memory <= self.memory_limit
+
+    def estimate_memory(self, books):
+        index = ImageIndex(self.maker_options.get("index_file"))
+        for book in books:
+            infos = index.scan(book.images).values()
+            largest = max((info.width * info.height for info in infos), default=0)
+            book.memory = largest * 4 * DECODE_COPIES * self.jobs_per_book + self.maker_options.get("prefetch", 0)
+        index.save()
+
+    def book_options(self, book: Book) -> dict:
+        options = dict(self.maker_options)
+        options.update(
+            input_dir=book.path, file=book.file, name=book.name, jobs=self.jobs_per_book,
+            fingerprint=book.fingerprint, update=book.file if book.metadata else None,
+        )
+        if options.get("profile"):
+            options["profile"] = f"{options['profile']}.{book.name}"
+        return options
+
+    def start(self, book: Book):
+        options = self.book_options(book)
+        options["progress"] = CmdProgress(self.progress) if self.parallel_books == 1 else None
+        book.status = "running"
+        book.start_time = time.perf_counter()
+        book.process = multiprocessing.Process(target=build_book, args=(options,))
+        book.process.start()
+
+    def dry_run(self):
+        """
+        Print what making the books would do, from the headers of their images, without making them.
+        """
+        plans = []
+        for book in self.find_pending():
+            plan = EPubMaker(master=None, **self.book_options(book)).plan()
+            plans.append(plan)
+            print(plan)
+            print()
+        for book in self.books:
+            if book.status == "skipped":
+                print(f"{book.name}: up to date")
+        print(
+            f"{len(plans)} books to make, {sum(len(plan.pages) for plan in plans)} pages, estimated size: "
+            f"{format_size(sum(plan.bytes_out for plan in plans))}, estimated time: "
+            f"{format_duration(sum(plan.seconds for plan in plans) / self.parallel_books)} with "
+            f"{self.parallel_books} books at a time"
+        )
+
+    def print_summary(self):
+        width = max([len("Book")] + [len(book.name) for book in self.books])
+        print()
+        print(f"{'Book':<{width}}  {'Status':<8}  {'Time':>8}  {'Size':>8}")
+        for book in self.books:
+            size = book.size
+            print(
+                f"{book.name:<{width}}  {book.status:<8}  {book.seconds:>7.1f}s  "
+                f"{format_size(size) if size is not None else '-':>8}"
+            )
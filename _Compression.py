@@ -0,0 +1,153 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import os
+import time
+import zlib
+from typing import Optional, Tuple
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
+
+from _ZipTools import copy_raw
+
+DEFAULT_LEVEL = 6
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_THRESHOLD = 0.9
+STREAM_BUFFER_SIZE = 64 * 1024
+ALREADY_COMPRESSED = {'image/jpeg', 'image/png', 'image/gif'}
+
+
+def format_size(size) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+class CompressionPolicy:
+    """
+    Decides per member of the archive how it is compressed. Images in formats that are already compressed are stored,
+    everything else is deflated with the given level. When sample is set, a sample of every image is deflated to
+    decide whether compressing the image is worth it, which also estimates how much time storing it saved.
+    """
+
+    def __init__(self, level=DEFAULT_LEVEL, sample=False):
+        self.level = level
+        self.sample = sample
+        self.deflated_members = 0
+        self.deflated_in = 0
+        self.deflated_out = 0
+        self.deflate_time = 0.0
+        self.stored_members = 0
+        self.stored_bytes = 0
+        self.estimated_time_saved = 0.0
+        self.estimated_bytes_lost = 0
+
+    def choose(self, file_type: Optional[str], size: int, sample: Optional[bytes]) -> Tuple[int, Optional[int]]:
+        """
+        :return: the compression type and level for a member
+        """
+        if file_type not in ALREADY_COMPRESSED:
+            return ZIP_DEFLATED, self.level
+        if not sample:
+            return ZIP_STORED, None
+
+        start = time.thread_time()
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = len(compressor.compress(sample)) + len(compressor.flush())
+        elapsed = time.thread_time() - start
+        ratio = compressed / len(sample)
+        if ratio < SAMPLE_THRESHOLD:
+            return ZIP_DEFLATED, self.level
+        self.estimated_time_saved += elapsed * size / len(sample)
+        self.estimated_bytes_lost += int(size * (1 - ratio))
+        return ZIP_STORED, None
+
+    def write(self, archive: ZipFile, name: str, data=None, source=None, file_type: Optional[str] = None):
+        """
+        Write a member to the archive, either from data or from the file source.
+        """
+        if data is not None:
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            size = len(data)
+            sample = data[:SAMPLE_SIZE] if self.sample else None
+        else:
+            size = os.path.getsize(source)
+            sample = None
+            if self.sample and file_type in ALREADY_COMPRESSED:
+                with open(source, 'rb') as file:
+                    sample = file.read(SAMPLE_SIZE)
+        compress_type, level = self.choose(file_type, size, sample)
+
+        start = time.thread_time()
+        if data is not None:
+            archive.writestr(name, data, compress_type=compress_type, compresslevel=level)
+        else:
+            archive.write(source, name, compress_type=compress_type, compresslevel=level)
+        self.count(archive.getinfo(name), time.thread_time() - start)
+
+    def copy(self, source: ZipFile, name: str, archive: ZipFile, target_name: str = None):
+        """
+        Copy a member from another archive without decompressing it, so it keeps the compression it has there.
+        """
+        copy_raw(source, name, archive, target_name)
+        self.count(archive.getinfo(target_name or name))
+
+    def write_stream(self, archive: ZipFile, name: str, chunks):
+        """
+        Write a text member to the archive from an iterable of strings, without joining them first. The member is
+        deflated with the compression and level of the archive, which should be ZIP_DEFLATED and self.level. As the
+        producing of the chunks can not be separated from compressing them, the time is not added to the summary.
+        """
+        buffer = []
+        buffered = 0
+        with archive.open(name, 'w') as member:
+            for chunk in chunks:
+                buffer.append(chunk)
+                buffered += len(chunk)
+                if STREAM_BUFFER_SIZE <= buffered:
+                    member.write("".join(buffer).encode("utf-8"))
+                    buffer, buffered = [], 0
+            member.write("".join(buffer).encode("utf-8"))
+        self.count(archive.getinfo(name))
+
+    def count(self, info: ZipInfo, elapsed=0.0):
+        """
+        Add a member that was written to the summary, with the time it took to deflate it if it is known.
+        """
+        if info.compress_type == ZIP_STORED:
+            self.stored_members += 1
+            self.stored_bytes += info.file_size
+        else:
+            self.deflated_members += 1
+            self.deflated_in += info.file_size
+            self.deflated_out += info.compress_size
+            self.deflate_time += elapsed
+
+    def summary(self) -> str:
+        result = (
+            f"Compression: {self.deflated_members} members deflated ({format_size(self.deflated_in)} to "
+            f"{format_size(self.deflated_out)} in {self.deflate_time:.2f}s), {self.stored_members} members stored "
+            f"({format_size(self.stored_bytes)})"
+        )
+        if self.sample:
+            result += (
+                f", storing saved about {self.estimated_time_saved:.2f}s of CPU time for "
+                f"{format_size(self.estimated_bytes_lost)}"
+            )
+        return result
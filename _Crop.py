@@ -0,0 +1,109 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import math
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+# how many gray levels a pixel may differ from the color of the border and still be part of the margin, which allows
+# for the noise of scans and JPEG compression
+DEFAULT_TOLERANCE = 32
+# the margin that is kept around the content, in percent of the width and height of the page
+DEFAULT_MARGIN = 1.0
+# a row or column is part of the margin if fewer than this part of its pixels differ from the border, so dust and
+# specks are not taken for content
+NOISE_PART = 0.005
+# pages of which the content is smaller than this part of the page in either direction are not cropped, like pages
+# that are almost empty
+MIN_CONTENT_PART = 0.25
+# the largest factor by which a JPEG image is scaled down while decoding it to find its content
+DRAFT_SCALE = 8
+
+
+def find_content(pixels, tolerance: int) -> Optional[List[int]]:
+    """
+    Find the content of a grayscale image, which is everything that differs from the color of its border.
+
+    :param pixels: the image as a 2D array
+    :return: the left, top, right, and bottom of the content, or None if the image has no content
+    """
+    import numpy
+
+    pixels = pixels.astype(numpy.int16)
+    height, width = pixels.shape
+    background = numpy.median(numpy.concatenate((pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1])))
+    content = numpy.abs(pixels - background) > tolerance
+    rows = numpy.flatnonzero(numpy.count_nonzero(content, axis=1) > width * NOISE_PART)
+    columns = numpy.flatnonzero(numpy.count_nonzero(content, axis=0) > height * NOISE_PART)
+    if not len(rows) or not len(columns):
+        return None
+    return [int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1]
+
+
+def content_box(source, tolerance: int) -> Optional[List[int]]:
+    """
+    Find the content of an image. JPEG images are scaled down while they are decoded, and the content is made larger
+    by a pixel of the smaller image to make up for it.
+
+    :param source: the path or the content of the image
+    :return: the left, top, right, and bottom of the content, or None if the image has no content
+    """
+    import numpy
+    import PIL.Image
+
+    with PIL.Image.open(BytesIO(source) if isinstance(source, bytes) else source) as image_data:
+        width, height = image_data.size
+        if image_data.format == "JPEG":
+            image_data.draft("L", (width // DRAFT_SCALE, height // DRAFT_SCALE))
+        pixels = numpy.asarray(image_data.convert("L"))
+    found = find_content(pixels, tolerance)
+    if not found:
+        return None
+    scale_x, scale_y = width / pixels.shape[1], height / pixels.shape[0]
+    left, top, right, bottom = found
+    return [
+        max(0, math.floor((left - 1) * scale_x)), max(0, math.floor((top - 1) * scale_y)),
+        min(width, math.ceil((right + 1) * scale_x)), min(height, math.ceil((bottom + 1) * scale_y)),
+    ]
+
+
+def union(box: Optional[List[int]], other: Optional[List[int]]) -> Optional[List[int]]:
+    if not box or not other:
+        return box or other
+    return [min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3])]
+
+
+def crop_box(content: Optional[List[int]], size: Tuple[int, int], margin: float) -> Optional[List[int]]:
+    """
+    :param content: the content of the image
+    :param margin: the margin kept around the content, in percent of the size of the image
+    :return: the part of the image that is kept, or None if the image is not cropped
+    """
+    width, height = size
+    if not content or content[2] - content[0] < width * MIN_CONTENT_PART or \
+            content[3] - content[1] < height * MIN_CONTENT_PART:
+        return None
+    margin_x, margin_y = round(width * margin / 100), round(height * margin / 100)
+    box = [
+        max(0, content[0] - margin_x), max(0, content[1] - margin_y),
+        min(width, content[2] + margin_x), min(height, content[3] + margin_y),
+    ]
+    return None if box == [0, 0, width, height] else box
+
+
+def crop_size(box: List[int]) -> Tuple[int, int]:
+    return box[2] - box[0], box[3] - box[1]
@@ -0,0 +1,126 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+from io import BytesIO
+from typing import Optional, Dict, List
+
+from _Compression import format_size
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def perceptual_hash(image_data) -> int:
+    """
+    Compute the difference hash of an image: a 64 bit number of which every bit tells whether a pixel of a small
+    grayscale version of the image is brighter than its neighbour. Similar images have hashes that differ in few bits.
+    """
+    import PIL.Image
+
+    small = image_data.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), PIL.Image.BOX)
+    pixels = list(small.getdata())
+    result = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            index = row * (HASH_SIZE + 1) + column
+            result = (result << 1) | (pixels[index] > pixels[index + 1])
+    return result
+
+
+def perceptual_hash_of(source) -> int:
+    """
+    Compute the perceptual hash of the image at the path or with the content source. JPEG images are decoded at a
+    reduced size, as the hash only needs a few pixels.
+    """
+    import PIL.Image
+
+    with PIL.Image.open(BytesIO(source) if isinstance(source, bytes) else source) as image_data:
+        if image_data.format == "JPEG":
+            image_data.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+        return perceptual_hash(image_data)
+
+
+class Deduplicator:
+    """
+    Finds pages that were already added to the ePub. Pages with exactly the same content are always found. If a
+    threshold is given, pages of which the perceptual hash differs in at most threshold bits are found as well.
+
+    To avoid comparing every hash with all others, the hashes are split in threshold + 1 bands. If two hashes differ
+    in at most threshold bits, at least one of the bands is the same, so only hashes with a same band are compared.
+    """
+
+    def __init__(self, threshold: Optional[int] = None):
+        self.threshold = threshold
+        self.exact: Dict[str, str] = {}
+        self.bands: List[Dict[int, List[tuple]]] = []
+        if threshold is not None:
+            self.band_count = threshold + 1
+            self.band_bits = HASH_BITS // self.band_count
+            self.bands = [{} for _ in range(self.band_count)]
+        self.duplicates = 0
+        self.bytes_saved = 0
+
+    @property
+    def perceptual(self) -> bool:
+        return self.threshold is not None
+
+    def find_exact(self, content_hash: str, image_id: str) -> Optional[str]:
+        """
+        :return: the id of the image with the same content, or None if this is the first image with this content
+        """
+        original = self.exact.get(content_hash)
+        if original is None:
+            self.exact[content_hash] = image_id
+        return original
+
+    def set_original(self, content_hash: str, image_id: str):
+        self.exact[content_hash] = image_id
+
+    def reset(self):
+        """
+        Forget the images found so far, but keep counting the duplicates.
+        """
+        self.exact.clear()
+        for band in self.bands:
+            band.clear()
+
+    def split(self, value: int):
+        for band in range(self.band_count):
+            shift = band * self.band_bits
+            bits = self.band_bits if band < self.band_count - 1 else HASH_BITS - shift
+            yield (value >> shift) & ((1 << bits) - 1)
+
+    def find_similar(self, value: int, image_id: str) -> Optional[str]:
+        """
+        :return: the id of an image with a similar perceptual hash, or None if there is none, in which case the image
+            is added so later images can be found to be similar to it
+        """
+        parts = list(self.split(value))
+        for band, part in zip(self.bands, parts):
+            for other, other_id in band.get(part, ()):
+                if bin(value ^ other).count("1") <= self.threshold:
+                    return other_id
+        for band, part in zip(self.bands, parts):
+            band.setdefault(part, []).append((value, image_id))
+        return None
+
+    def add_duplicate(self, size: int):
+        self.duplicates += 1
+        self.bytes_saved += size
+
+    def summary(self) -> str:
+        return f"Deduplication: {self.duplicates} duplicate pages, {format_size(self.bytes_saved)} saved"
@@ -0,0 +1,92 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import importlib.util
+
+from _Profiles import OUTPUT_FORMATS
+
+# e-ink screens show 16 levels of gray
+EINK_LEVELS = 16
+# the quality of JPEG pages, which is more than enough for 16 levels of gray
+EINK_JPEG_QUALITY = 85
+DEFAULT_GAMMA = 1.0
+BAYER_SIZE = 8
+
+
+def numpy_available() -> bool:
+    return importlib.util.find_spec("numpy") is not None
+
+
+def bayer_matrix(size: int):
+    """
+    :return: the ordered dither thresholds of a size by size Bayer matrix, between -0.5 and 0.5
+    """
+    import numpy
+
+    matrix = numpy.zeros((1, 1), dtype=numpy.float32)
+    while matrix.shape[0] < size:
+        matrix = numpy.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return (matrix + 0.5) / matrix.size - 0.5
+
+
+def quantize(image_data, gamma=DEFAULT_GAMMA, black_point=0, white_point=255, dither=False):
+    """
+    Turn an image into the 16 levels of gray of an e-ink screen. The levels are stretched so black_point becomes
+    black and white_point becomes white, then gamma is applied, where a gamma above 1 brightens the midtones. Ordered
+    dithering keeps smooth gradients from turning into bands, and can be done for all pixels at once unlike error
+    diffusion.
+
+    :return: the levels of the pixels as a 2D array of uint8 values from 0 to 15
+    """
+    import numpy
+
+    pixels = numpy.asarray(image_data.convert("L"), dtype=numpy.float32)
+    pixels = numpy.clip((pixels - black_point) / max(1, white_point - black_point), 0.0, 1.0)
+    if gamma != 1.0:
+        pixels **= 1.0 / gamma
+    pixels *= EINK_LEVELS - 1
+    if dither:
+        height, width = pixels.shape
+        thresholds = bayer_matrix(BAYER_SIZE)
+        pixels += numpy.tile(thresholds, (height // BAYER_SIZE + 1, width // BAYER_SIZE + 1))[:height, :width]
+    return numpy.clip(numpy.rint(pixels), 0, EINK_LEVELS - 1).astype(numpy.uint8)
+
+
+def eink_image(image_data, output_format: str, **options):
+    """
+    :return: the image with 16 levels of gray, as a 4 bit palette image for PNG or as a grayscale image for JPEG,
+        which has no chroma channels to spend bytes on
+    """
+    import PIL.Image
+
+    levels = quantize(image_data, **options)
+    height, width = levels.shape
+    if output_format == "png":
+        result = PIL.Image.frombytes("P", (width, height), levels.tobytes())
+        result.putpalette([
+            value for level in range(EINK_LEVELS) for value in (level * 255 // (EINK_LEVELS - 1),) * 3
+        ])
+        return result
+    return PIL.Image.frombytes("L", (width, height), (levels * (255 // (EINK_LEVELS - 1))).tobytes())
+
+
+def save_eink(image_data, output, output_format: str):
+    image_format = OUTPUT_FORMATS[output_format][0]
+    if output_format == "png":
+        image_data.save(output, format=image_format, bits=4, optimize=True)
+    else:
+        image_data.save(output, format=image_format, quality=EINK_JPEG_QUALITY, optimize=True)
@@ -23,13 +23,22 @@ from queue import Queue, Empty
 from tkinter.filedialog import askdirectory, asksaveasfilename
 from typing import Optional
 
-from _ePubMaker import EPubMaker
+from _Progress import format_rates
+from _ePubMaker import EPubMaker, RESAMPLE_FILTERS, DEFAULT_RESAMPLE, DEFAULT_REDUCING_GAP
 
 COLOR_ERROR = "red"
 COLOR_NORMAL = "black"
 UPDATE_TIME = 100
 
 
+def is_float(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
 def validate(condition, entry, result):
     if not condition:
         entry.config(highlightbackground=COLOR_ERROR)
@@ -40,11 +49,12 @@ def validate(condition, entry, result):
 
 class MainFrame(tk.Frame):
     def __init__(self, _master, input_dir=None, file=None, name="", grayscale=False, max_width=None, max_height=None,
-                 wrap_pages=True):
+                 wrap_pages=True, resample=DEFAULT_RESAMPLE, reducing_gap=DEFAULT_REDUCING_GAP, **maker_options):
         tk.Frame.__init__(self, master=_master, width=525, height=200)
         self.master.protocol("WM_DELETE_WINDOW", self.close)
         self.generic_queue = Queue()
         self.progress_queue = Queue()
+        self.status_queue = Queue()
 
         if input_dir and os.path.isdir(input_dir):
             self.input_dir = input_dir
@@ -53,6 +63,7 @@ class MainFrame(tk.Frame):
             self.input_dir = None
             self.input_dir_var = tk.StringVar(value="No directory given")
         self.file = file
+        self.maker_options = maker_options
         self.working = False
         self.thread: Optional[EPubMaker] = None
         self.showerror = mbox.showerror
@@ -105,9 +116,25 @@ class MainFrame(tk.Frame):
         self.max_height_entry.config(width=15)
         self.max_height_entry.grid(row=0, column=3, padx=5)
 
+        # resize quality
+        resize_frame = tk.Frame(panel)
+        resize_frame.grid(row=4, column=0, columnspan=2, pady=3)
+        tk.Label(resize_frame, text="Resize filter: ").grid(row=0, column=0)
+        self.resample = tk.StringVar(value=resample)
+        self.resample_entry = ttk.Combobox(
+            resize_frame, textvariable=self.resample, values=list(RESAMPLE_FILTERS), state='readonly'
+        )
+        self.resample_entry.config(width=12)
+        self.resample_entry.grid(row=0, column=1, padx=5)
+        tk.Label(resize_frame, text="Reducing gap: ").grid(row=0, column=2)
+        self.reducing_gap = tk.StringVar(value=reducing_gap or "")
+        self.reducing_gap_entry = tk.Entry(resize_frame, textvariable=self.reducing_gap)
+        self.reducing_gap_entry.config(width=15)
+        self.reducing_gap_entry.grid(row=0, column=3, padx=5)
+
         # options
         options_frame = tk.Frame(panel)
-        options_frame.grid(row=4, column=0, columnspan=2, pady=3)
+        options_frame.grid(row=5, column=0, columnspan=2, pady=3)
         self.grayscale = tk.BooleanVar(value=grayscale)
         self.grayscale_entry = tk.Checkbutton(options_frame, text="Grayscale", variable=self.grayscale)
         self.grayscale_entry.grid(row=0, column=0, padx=5)
@@ -117,7 +144,7 @@ class MainFrame(tk.Frame):
 
         # progress
         progress = tk.Frame(panel)
-        progress.grid(row=5, column=0, columnspan=2, pady=3)
+        progress.grid(row=6, column=0, columnspan=2, pady=3)
         self.button_start = tk.Button(progress, text="Start", command=self.start)
         self.button_start.config(width=10)
         self.button_start.grid(row=0, column=0, padx=5, pady=3)
@@ -129,6 +156,9 @@ class MainFrame(tk.Frame):
         self.button_stop.config(width=10)
         self.button_stop.grid(row=0, column=2, padx=5, pady=3)
 
+        self.status = tk.StringVar(value="")
+        tk.Label(progress, textvariable=self.status).grid(row=1, column=0, columnspan=3)
+
         self.set_state()
 
         self.pack(expand=True)
@@ -148,12 +178,17 @@ class MainFrame(tk.Frame):
     def get_invalid(self):
         max_width = self.max_width.get()
         max_height = self.max_height.get()
+        reducing_gap = self.reducing_gap.get()
         result = [
             validate(self.input_dir and os.path.isdir(self.input_dir), self.input_dir_entry, "input directory"),
             validate(self.file, self.file_entry, "ouput file"),
             validate(self.name.get(), self.name_entry, "name"),
             validate(not max_width or max_width.isnumeric(), self.max_width_entry, "maximum width"),
             validate(not max_height or max_height.isnumeric(), self.max_height_entry, "maximum height"),
+            validate(
+                not reducing_gap or (is_float(reducing_gap) and 1 <= float(reducing_gap)), self.reducing_gap_entry,
+                "reducing gap"
+            ),
         ]
         return list(filter(None, result))
 
@@ -166,6 +201,8 @@ class MainFrame(tk.Frame):
         self.wrap_pages_entry.config(state=state)
         self.max_width_entry.config(state=state)
         self.max_height_entry.config(state=state)
+        self.resample_entry.config(state='readonly' if not self.working else tk.DISABLED)
+        self.reducing_gap_entry.config(state=state)
         self.button_stop.config(state=tk.NORMAL if self.working else tk.DISABLED)
         self.button_start.config(state=tk.NORMAL if not self.working else tk.DISABLED)
         return True
@@ -175,10 +212,13 @@ class MainFrame(tk.Frame):
         if not invalid:
             self.working = True
             max_width, max_height = self.max_width.get(), self.max_height.get()
+            reducing_gap = self.reducing_gap.get()
             self.thread = EPubMaker(
                 master=self, input_dir=self.input_dir, file=self.file, name=self.name.get(),
                 wrap_pages=self.wrap_pages.get(), max_width=int(max_width) if max_width else None,
                 max_height=int(max_height) if max_height else None, grayscale=self.grayscale.get(),
+                resample=self.resample.get(), reducing_gap=float(reducing_gap) if reducing_gap else None,
+                **self.maker_options
             )
             self.thread.start()
         else:
@@ -199,11 +239,11 @@ class MainFrame(tk.Frame):
             self.progress["value"] = value
         self.set_state()
 
-    def clear_progress_queue(self):
+    def clear_progress_queue(self, queue=None):
         last = None
         try:
             while True:
-                last = self.progress_queue.get_nowait()
+                last = (queue or self.progress_queue).get_nowait()
         except Empty:
             return last
 
@@ -214,6 +254,17 @@ class MainFrame(tk.Frame):
     def progress_set_value(self, value):
         self.progress_queue.put(lambda: setitem(self.progress, "value", value))
 
+    def progress_event(self, event):
+        if event["event"] == "phase":
+            text = f"Phase: {event['phase'].replace('_', ' ')}"
+        elif event["event"] == "page":
+            text = format_rates(event)
+        elif event["event"] == "done":
+            text = f"{event['pages']} pages in {event['seconds']:.1f}s"
+        else:
+            return
+        self.status_queue.put(lambda: self.status.set(text))
+
     def close(self):
         self.stop()
         self.master.destroy()
@@ -224,17 +275,19 @@ class MainFrame(tk.Frame):
                 self.generic_queue.get_nowait()()
         except Empty:
             pass
-        last = self.clear_progress_queue()
-        if last is not None:
-            last()
+        for queue in (self.progress_queue, self.status_queue):
+            last = self.clear_progress_queue(queue)
+            if last is not None:
+                last()
         self.after(UPDATE_TIME, self.process_queue)
 
 
-def start_gui(input_dir=None, file=None, name="", grayscale=False, max_width=None, max_height=None, wrap_pages=True):
+def start_gui(input_dir=None, file=None, name="", grayscale=False, max_width=None, max_height=None, wrap_pages=True,
+              resample=DEFAULT_RESAMPLE, reducing_gap=DEFAULT_REDUCING_GAP, **maker_options):
     root = tk.Tk()
     MainFrame(
         root, input_dir=input_dir, file=file, name=name, grayscale=grayscale, max_width=max_width,
-        max_height=max_height, wrap_pages=wrap_pages
+        max_height=max_height, wrap_pages=wrap_pages, resample=resample, reducing_gap=reducing_gap, **maker_options
     ).mainloop()
 
 
@@ -0,0 +1,132 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, NamedTuple, Dict, Iterable, Tuple
+
+from _Strips import PNG_MODES, png_header
+
+INDEX_VERSION = 1
+
+
+class ImageInfo(NamedTuple):
+    width: int
+    height: int
+    type: str
+    mode: str
+    size: int
+    mtime: int
+
+
+def read_header(file, size, mtime) -> ImageInfo:
+    """
+    Read the information about an image from its header. The pixels are not decoded.
+    """
+    import PIL.Image
+
+    with file:
+        try:
+            with PIL.Image.open(file) as image_data:
+                return ImageInfo(*image_data.size, image_data.get_format_mimetype(), image_data.mode, size, mtime)
+        except PIL.Image.DecompressionBombError:
+            # a strip that is too large to decode at once can still be cut in pages, which are decoded in bands
+            file.seek(0)
+            header = png_header(file)
+            if not header or not header.streamable:
+                raise
+            return ImageInfo(header.width, header.height, "image/png", PNG_MODES[header.color_type], size, mtime)
+
+
+class ImageIndex:
+    """
+    The information of the headers of images, and what was found by decoding images, like the rows at which strips
+    are cut in pages. If a file is given, the index is stored in it, so later runs only read the headers of images of
+    which the size or modification time changed, and only decode the images that changed.
+    """
+
+    def __init__(self, file=None):
+        self.file = file
+        self.entries: Dict[str, ImageInfo] = {}
+        # by kind, the size and modification time of every image, the parameters, and what was found with them
+        self.analyses: Dict[str, Dict[str, list]] = {}
+        if file:
+            self.load()
+        self.scanned = 0
+
+    def load(self):
+        try:
+            with open(self.file, encoding='utf-8') as file:
+                index = json.load(file)
+        except (IOError, ValueError):
+            return
+        if index.get("version") != INDEX_VERSION:
+            return
+        self.entries = {source: ImageInfo(*info) for source, info in index["entries"].items()}
+        self.analyses = index.get("analyses", {})
+
+    def save(self):
+        if not self.file:
+            return
+        # runs in other threads or processes may save the same index at the same time
+        temp_file = f"{self.file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as file:
+            json.dump({"version": INDEX_VERSION, "entries": self.entries, "analyses": self.analyses}, file)
+        os.replace(temp_file, self.file)
+
+    def scan(self, sources: Iterable[Tuple[str, int, int]], opener=None) -> Dict[str, ImageInfo]:
+        """
+        Get the information of the given images, reading the headers of the images that are not in the index on
+        multiple threads.
+
+        :param sources: the path, size, and modification time of every image
+        :param opener: opens the path of an image as binary file, by default the path is opened as file
+        :return: the information of every image by path
+        """
+        opener = opener or (lambda source: open(source, 'rb'))
+        result = {}
+        missing = []
+        for source, size, mtime in sources:
+            info = self.entries.get(os.path.abspath(source))
+            if info and info.size == size and info.mtime == mtime:
+                result[source] = info
+            else:
+                missing.append((source, size, mtime))
+
+        with ThreadPoolExecutor() as executor:
+            for (source, _, _), info in zip(missing, executor.map(
+                    lambda args: read_header(opener(args[0]), *args[1:]), missing)):
+                self.entries[os.path.abspath(source)] = result[source] = info
+        self.scanned += len(missing)
+        return result
+
+    def get_analysis(self, kind: str, source, info: ImageInfo, parameters) -> Tuple[bool, Any]:
+        """
+        :return: whether the image was analysed with the parameters since it last changed, and what was found
+        """
+        entry = self.analyses.get(kind, {}).get(os.path.abspath(source))
+        if entry and entry[:3] == [info.size, info.mtime, parameters]:
+            return True, entry[3]
+        return False, None
+
+    def set_analysis(self, kind: str, source, info: ImageInfo, parameters, result):
+        """
+        :param parameters: the parameters of the analysis, which are stored as JSON
+        """
+        self.analyses.setdefault(kind, {})[os.path.abspath(source)] = [info.size, info.mtime, parameters, result]
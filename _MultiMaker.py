@@ -0,0 +1,148 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import sys
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from _ePubMaker import EPubMaker, TransformSettings, transcode_many, worker_pool
+from _Sources import open_source, is_source
+
+
+class SharedTranscoder:
+    """
+    Transcodes the images of several EPubMakers of the same directory, so every image is decoded once and then
+    transformed for every maker that needs it. Every maker tells, for every image in order, whether it needs the image
+    transcoded. An image is transcoded once all makers told, so a maker that leaves, because it is done or failed,
+    counts as not needing any of the remaining images.
+    """
+
+    def __init__(self, makers: int, jobs=1):
+        self.makers = makers
+        self.executor = worker_pool(jobs) if 1 < jobs else None
+        self.lock = threading.Lock()
+        # the requests of the makers by the position of the image, and the makers that left
+        self.requests: Dict[int, Dict[int, Optional[tuple]]] = {}
+        self.left = set()
+
+    def request(self, maker: int, position: int, source=None, settings: TransformSettings = None,
+                perceptual=False, box=None) -> Optional[Future]:
+        """
+        Tell whether the maker needs the image at the position transcoded, by giving its source and settings. The
+        makers crop an image the same, as they share the options of the crop.
+        :return: the future of the result if the image is needed
+        """
+        future = Future() if source is not None else None
+        with self.lock:
+            requests = self.requests.setdefault(position, {})
+            requests[maker] = (source, settings, perceptual, box, future) if future else None
+            ready = self.pop_ready(position)
+        if ready:
+            self.submit(ready)
+        return future
+
+    def leave(self, maker: int):
+        with self.lock:
+            self.left.add(maker)
+            ready = [self.pop_ready(position) for position in list(self.requests)]
+        for requests in ready:
+            if requests:
+                self.submit(requests)
+
+    def pop_ready(self, position) -> Optional[list]:
+        """
+        :return: the requests for the image at the position if every maker told whether it needs it
+        """
+        requests = self.requests[position]
+        if any(maker not in requests and maker not in self.left for maker in range(self.makers)):
+            return None
+        del self.requests[position]
+        return [request for request in requests.values() if request]
+
+    def submit(self, requests: list):
+        source, box = requests[0][0], requests[0][3]
+        targets = [(settings, perceptual) for _, settings, perceptual, _, _ in requests]
+        futures = [future for *_, future in requests]
+        if self.executor:
+            self.executor.submit(transcode_many, source, targets, box).add_done_callback(
+                lambda done: self.resolve(futures, done))
+        else:
+            done = Future()
+            try:
+                done.set_result(transcode_many(source, targets, box))
+            except Exception as e:
+                done.set_exception(e)
+            self.resolve(futures, done)
+
+    @staticmethod
+    def resolve(futures: List[Future], done: Future):
+        error = done.exception()
+        for position, future in enumerate(futures):
+            # the maker cancels the futures it no longer waits for
+            if not future.set_running_or_notify_cancel():
+                continue
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(done.result()[position])
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=True)
+
+
+class MultiEPubMaker:
+    """
+    Makes several ePubs of the same directory, each with its own options, in a single pass: the directory is walked
+    and the headers of the images are read once, every image is decoded once, and the ePubs are written at the same
+    time by their own EPubMaker threads. The first maker is the one of which the progress is shown.
+    """
+
+    def __init__(self, makers: List[EPubMaker], jobs=1):
+        self.makers = makers
+        self.jobs = jobs
+
+    def run(self) -> bool:
+        """
+        :return: whether all ePubs were made
+        """
+        leader = self.makers[0]
+        if not is_source(leader.dir):
+            print("Error encountered: The given directory or archive does not exist!", file=sys.stderr)
+            return False
+        with open_source(leader.dir) as leader.source:
+            leader.make_tree()
+            leader.index.scan(
+                ((image["source"], image["size"], image["mtime"]) for image in leader.images), leader.source.open)
+            if leader.crop:
+                # the content of the images is found once, so the makers only take it from the index
+                leader.find_crops()
+        leader.source = None
+        transcoder = SharedTranscoder(len(self.makers), self.jobs)
+        try:
+            for position, maker in enumerate(self.makers):
+                maker.share(leader.chapter_tree, leader.images, leader.cover, leader.index, transcoder, position)
+            for maker in self.makers:
+                maker.start()
+            for maker in self.makers:
+                maker.join()
+        finally:
+            transcoder.close()
+        for maker in self.makers:
+            print(f"{maker.file}: {'failed' if maker.error else 'created'}")
+        return not any(maker.error for maker in self.makers)
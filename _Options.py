@@ -0,0 +1,72 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+from _EInk import numpy_available
+
+# the defaults of the options of the server and of watching directories, which are kept here so the command line does
+# not import the server and the watcher to show them
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_SETTLE = 2.0
+# the lowest and highest value of the numeric options of an EPubMaker, where None is no bound, and how they are named
+# in the errors
+OPTION_RANGES = {
+    "jobs": (0, None, "the number of jobs"),
+    "cache_size": (1, None, "the cache size"),
+    "max_width": (1, None, "the maximum width"),
+    "max_height": (1, None, "the maximum height"),
+    "compression_level": (0, 9, "the compression level"),
+    "dedup_threshold": (0, 31, "the dedup threshold"),
+    "page_bytes": (1, None, "the page budget"),
+    "book_bytes": (1, None, "the book budget"),
+    "split_size": (1, None, "the split size"),
+    "split_pages": (1, None, "the split pages"),
+    "prefetch": (0, None, "the prefetch size"),
+    "black_point": (0, 255, "the black point"),
+    "white_point": (0, 255, "the white point"),
+    "crop_tolerance": (0, 254, "the crop tolerance"),
+    "crop_margin": (0, None, "the crop margin"),
+}
+
+
+def check_maker_options(options: dict):
+    """
+    Check the options of an EPubMaker that are given by a user, on the command line or to the server, so a value that
+    is out of range is refused before a book is made with it. Options that are missing or None are not checked.
+
+    :raise ValueError: with the reason if an option is not valid
+    """
+    for key, (minimum, maximum, name) in OPTION_RANGES.items():
+        value = options.get(key)
+        if value is None:
+            continue
+        if maximum is None and value < minimum:
+            raise ValueError(f"{name} must be at least {minimum}")
+        if maximum is not None and not minimum <= value <= maximum:
+            raise ValueError(f"{name} must be between {minimum} and {maximum}")
+    if options.get("black_point", 0) >= options.get("white_point", 255):
+        raise ValueError("the black point must be below the white point")
+    if options.get("gamma") is not None and options["gamma"] <= 0:
+        raise ValueError("the gamma must be more than 0")
+    if options.get("reducing_gap") is not None and options["reducing_gap"] < 1:
+        raise ValueError("the reducing gap must be 0 or at least 1")
+    if not options.get("wrap_pages", True) and (options.get("dedup") or options.get("dedup_threshold") is not None):
+        raise ValueError("duplicate pages can only be removed when the pages are wrapped")
+    if options.get("eink") and not numpy_available():
+        raise ValueError("e-ink pages need NumPy, install it with pip install numpy")
+    if options.get("crop") and not numpy_available():
+        raise ValueError("cropping needs NumPy, install it with pip install numpy")
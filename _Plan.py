@@ -0,0 +1,166 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+from collections import Counter
+from typing import List, NamedTuple, Optional, Tuple
+
+from _Compression import format_size
+from _Progress import format_duration
+
+# the time a single core takes to decode, resize, and encode a million pixels of an image of a type, which is rough
+# but good enough to tell a book of minutes from a book of hours
+SECONDS_PER_MEGAPIXEL = {"image/jpeg": 0.015, "image/png": 0.15, "image/gif": 0.05}
+# the speed at which images that are not transcoded are copied into the ePub
+COPY_BYTES_PER_SECOND = 200 * 1024 * 1024
+# the size of an image that is made grayscale compared to the size of the color image
+GRAYSCALE_SIZE_RATIO = 0.6
+# the size of an image with 16 levels of gray compared to the size of the grayscale image
+EINK_SIZE_RATIO = 0.5
+# how much longer converting an image takes when its quality is searched to fit in a budget
+BUDGET_TIME_FACTOR = 3
+# the size of the page of an image and the entries of the image and the page in the zip file
+PAGE_OVERHEAD = 600
+# the largest factor by which the JPEG decoder can scale down an image while decoding it
+MAX_DRAFT_SCALE = 8
+
+
+class PagePlan(NamedTuple):
+    # "copy" if the image is copied as-is, "reuse" if it is copied from the ePub that is updated, else "transcode"
+    action: str
+    size: Tuple[int, int]
+    new_size: Optional[Tuple[int, int]]
+    grayscale: bool
+    bytes_in: int
+    bytes_out: int
+    # the time it takes a single core to convert the image
+    seconds: float
+
+
+def decoded_pixels(info, new_size: Optional[Tuple[int, int]]) -> int:
+    """
+    :return: the number of pixels that are decoded, which is less than the size of a JPEG image that is made smaller
+    """
+    width, height = info.width, info.height
+    if new_size and info.type == "image/jpeg":
+        scale = 1
+        while scale < MAX_DRAFT_SCALE and new_size[0] <= width // (scale * 2) and new_size[1] <= height // (scale * 2):
+            scale *= 2
+        width, height = width // scale, height // scale
+    return width * height
+
+
+def plan_page(info, transcode: bool, new_size: Optional[Tuple[int, int]], grayscale: bool, eink=False,
+              max_bytes: Optional[int] = None) -> PagePlan:
+    """
+    Estimate the size and conversion time of an image from its header.
+
+    :param transcode: whether the image is transcoded, or else copied as-is
+    :param new_size: the size the image is resized to, if it is resized
+    :param grayscale: whether the image is made grayscale
+    :param eink: whether the image is turned into 16 levels of gray
+    :param max_bytes: the budget of the page, if any, for which the quality of the image is searched
+    """
+    size = (info.width, info.height)
+    if not transcode:
+        return PagePlan("copy", size, None, False, info.size, info.size, info.size / COPY_BYTES_PER_SECOND)
+    width, height = new_size or size
+    bytes_out = info.size * (width * height) / max(1, info.width * info.height)
+    if grayscale:
+        bytes_out *= GRAYSCALE_SIZE_RATIO
+    if eink:
+        bytes_out *= EINK_SIZE_RATIO
+    seconds = decoded_pixels(info, new_size) / 1e6 * SECONDS_PER_MEGAPIXEL.get(info.type, 0.1)
+    if max_bytes:
+        bytes_out = min(bytes_out, max_bytes)
+        seconds *= BUDGET_TIME_FACTOR
+    return PagePlan("transcode", size, new_size, grayscale, info.size, int(bytes_out), seconds)
+
+
+def reuse_page(image, bytes_out: int) -> PagePlan:
+    size = (image["width"], image["height"])
+    return PagePlan("reuse", size, None, False, image["size"], bytes_out, bytes_out / COPY_BYTES_PER_SECOND)
+
+
+class BookPlan:
+    """
+    What making an ePub would do, as found from the chapters and the headers of the images without decoding them.
+    """
+
+    def __init__(self, name, file, chapter_tree, pages: List[PagePlan], jobs=1, crop: Optional[str] = None):
+        self.name = name
+        self.file = file
+        self.chapter_tree = chapter_tree
+        self.pages = pages
+        self.jobs = jobs
+        # the summary of the crop of the pages, if they are cropped
+        self.crop = crop
+
+    @property
+    def bytes_in(self) -> int:
+        return sum(page.bytes_in for page in self.pages)
+
+    @property
+    def bytes_out(self) -> int:
+        return sum(page.bytes_out + PAGE_OVERHEAD for page in self.pages)
+
+    @property
+    def seconds(self) -> float:
+        """
+        :return: the estimated build time, of which the transcoding is spread over the jobs
+        """
+        transcode = sum(page.seconds for page in self.pages if page.action == "transcode")
+        copy = sum(page.seconds for page in self.pages if page.action != "transcode")
+        return transcode / self.jobs + copy
+
+    def chapter_lines(self, chapter, depth=0) -> Tuple[List[str], int]:
+        """
+        :return: the lines of the chapter and its sub chapters, and the number of pages in them
+        """
+        lines = []
+        pages = len(chapter.images)
+        for child in chapter.children:
+            child_lines, child_pages = self.chapter_lines(child, depth + 1)
+            lines += child_lines
+            pages += child_pages
+        title = chapter.title if chapter.title is not None else self.name
+        return [f"{'  ' * depth}{title} ({pages} pages)"] + lines, pages
+
+    def __str__(self):
+        lines = [f"{self.name} -> {self.file}"]
+        if self.chapter_tree:
+            lines += ["  " + line for line in self.chapter_lines(self.chapter_tree)[0]]
+        actions = Counter(page.action for page in self.pages)
+        resizes = Counter((page.size, page.new_size) for page in self.pages if page.new_size)
+        lines.append(
+            f"{len(self.pages)} pages, {format_size(self.bytes_in)} of images: {actions['transcode']} transcoded, "
+            f"{actions['copy']} copied as-is, {actions['reuse']} reused from the ePub"
+        )
+        if resizes:
+            lines.append(f"Resized: {sum(resizes.values())} pages, " + ", ".join(
+                f"{count} from {size[0]}x{size[1]} to {new_size[0]}x{new_size[1]}"
+                for (size, new_size), count in resizes.most_common(3)
+            ) + (", ..." if 3 < len(resizes) else ""))
+        grayscale = sum(page.grayscale for page in self.pages)
+        if grayscale:
+            lines.append(f"Grayscale: {grayscale} pages")
+        if self.crop:
+            lines.append(self.crop)
+        lines.append(
+            f"Estimated size: {format_size(self.bytes_out)}, estimated time: {format_duration(self.seconds)} "
+            f"with {self.jobs} jobs"
+        )
+        return "\n".join(lines)
@@ -0,0 +1,120 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Tuple
+
+from _Compression import format_size
+
+PREFETCH_THREADS = 4
+
+
+class Prefetcher:
+    """
+    Reads the images ahead of the writer on background threads, so waiting for a slow (network) filesystem overlaps
+    with transcoding and writing the images before them. The images are read in the given order, and no more than
+    budget bytes are kept in memory, except for a single image that is larger than the budget on its own.
+
+    An image that is asked for before it was read ahead is read directly, so the writer never waits for the budget.
+    Every image should be released once it is written, which frees its part of the budget.
+    """
+
+    def __init__(self, read: Callable[[str], bytes], budget: int, threads=PREFETCH_THREADS):
+        self.read_source = read
+        self.budget = budget
+        self.used = 0
+        self.buffers: Dict[str, Tuple[Future, int]] = {}
+        self.started = set()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="prefetch")
+        self.thread = None
+        self.read_ahead = 0
+        self.read_directly = 0
+        self.bytes_read_ahead = 0
+        self.wait_time = 0.0
+
+    def start(self, sources: Iterable[Tuple[str, int]]):
+        """
+        Start reading the sources, given with their sizes, in the background.
+        """
+        self.thread = threading.Thread(target=self.schedule, args=(list(sources),), daemon=True)
+        self.thread.start()
+
+    def schedule(self, sources):
+        for source, size in sources:
+            with self.condition:
+                while self.used and self.budget < self.used + size and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                if source in self.started:
+                    continue
+                self.started.add(source)
+                self.used += size
+                self.buffers[source] = (self.executor.submit(self.read_source, source), size)
+                self.read_ahead += 1
+                self.bytes_read_ahead += size
+
+    def read(self, source) -> bytes:
+        """
+        :return: the content of the image, read ahead if possible
+        """
+        with self.condition:
+            future, _ = self.buffers.get(source, (None, 0))
+            # the scheduler skips an image that is read directly
+            self.started.add(source)
+        if future is None:
+            data = self.read_source(source)
+            future = Future()
+            future.set_result(data)
+            with self.condition:
+                # keep it until it is released, as an image can be read more than once
+                self.buffers[source] = (future, len(data))
+                self.used += len(data)
+                self.read_directly += 1
+            return data
+        if not future.done():
+            start = time.perf_counter()
+            future.result()
+            self.wait_time += time.perf_counter() - start
+        return future.result()
+
+    def release(self, source):
+        with self.condition:
+            _, size = self.buffers.pop(source, (None, 0))
+            self.used -= size
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            for future, _ in self.buffers.values():
+                future.cancel()
+            self.buffers.clear()
+            self.condition.notify_all()
+        self.executor.shutdown(wait=True)
+        if self.thread:
+            self.thread.join()
+
+    def summary(self) -> str:
+        return (
+            f"Prefetch: {self.read_ahead} images read ahead ({format_size(self.bytes_read_ahead)}), "
+            f"{self.read_directly} read directly, waited {self.wait_time:.2f}s"
+        )
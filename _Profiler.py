@@ -0,0 +1,121 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import List, Tuple
+
+# the name, start, wall time, and cpu time of a step
+Step = Tuple[str, float, float, float]
+
+
+class StepTimer:
+    """
+    Measures the steps of a single task, for example transcoding an image in a worker process. The steps can be
+    pickled and added to a Profiler in another process, as time.perf_counter is a system-wide clock.
+    """
+
+    def __init__(self):
+        self.steps: List[Step] = []
+
+    @contextmanager
+    def __call__(self, name):
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.steps.append((name, start, time.perf_counter() - start, time.thread_time() - start_cpu))
+
+
+class NullProfiler:
+    """
+    A profiler that records nothing, used when profiling is disabled.
+    """
+    enabled = False
+
+    def phase(self, name, **args):
+        return nullcontext()
+
+    def add_steps(self, steps, category, pid=None, tid=None, args=None):
+        pass
+
+    def add_page(self, **page):
+        pass
+
+    def save(self):
+        pass
+
+
+class Profiler(NullProfiler):
+    """
+    Records the wall and cpu time of the phases of making an ePub and of every page. The result is written to
+    <prefix>.json as summary and to <prefix>.trace.json in the Chrome trace event format, which can be opened with
+    chrome://tracing or Perfetto.
+    """
+    enabled = True
+
+    def __init__(self, prefix):
+        self.prefix = str(prefix)
+        self.origin = time.perf_counter()
+        self.phases = {}
+        self.pages = []
+        self.events = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, **args):
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_steps(
+                [(name, start, time.perf_counter() - start, time.thread_time() - start_cpu)], "phase", args=args)
+
+    def add_steps(self, steps, category, pid=None, tid=None, args=None):
+        pid = pid or os.getpid()
+        tid = tid or threading.get_ident()
+        with self.lock:
+            for name, start, wall, cpu in steps:
+                totals = self.phases.setdefault(name, {"count": 0, "wall": 0.0, "cpu": 0.0})
+                totals["count"] += 1
+                totals["wall"] += wall
+                totals["cpu"] += cpu
+                self.events.append({
+                    "name": name, "cat": category, "ph": "X", "pid": pid, "tid": tid,
+                    "ts": (start - self.origin) * 1e6, "dur": wall * 1e6, "args": dict(args or {}, cpu=cpu),
+                })
+
+    def add_page(self, **page):
+        with self.lock:
+            self.pages.append(page)
+
+    def save(self):
+        wall = time.perf_counter() - self.origin
+        summary = {
+            "wall": wall,
+            "phases": self.phases,
+            "bytes_in": sum(page.get("bytes_in", 0) for page in self.pages),
+            "bytes_out": sum(page.get("bytes_out", 0) for page in self.pages),
+            "pages": self.pages,
+        }
+        with open(self.prefix + ".json", 'w', encoding='utf-8') as file:
+            json.dump(summary, file, indent=1)
+        with open(self.prefix + ".trace.json", 'w', encoding='utf-8') as file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, file)
@@ -0,0 +1,122 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import math
+from io import BytesIO
+from typing import NamedTuple, Optional, Tuple
+
+# the formats images can be converted to, with their name in PIL, media type, and extension
+OUTPUT_FORMATS = {"png": ("PNG", "image/png", ".png"), "jpeg": ("JPEG", "image/jpeg", ".jpg")}
+# the range of JPEG qualities that is searched to fit a page in its budget
+MIN_QUALITY = 30
+MAX_QUALITY = 95
+# the lowest similarity, as peak signal-to-noise ratio in dB, of a page to the image before it was encoded: below this
+# compression artifacts become visible, so a page goes over its budget instead
+MIN_PSNR = 32.0
+
+
+class DeviceProfile(NamedTuple):
+    description: str
+    max_width: int
+    max_height: int
+    grayscale: bool
+    output_format: str
+    # the budget of every page in KB, and of the whole book in MB
+    page_kb: Optional[int] = None
+    book_mb: Optional[int] = None
+
+
+DEVICE_PROFILES = {
+    "kindle": DeviceProfile("Kindle Paperwhite and Oasis", 1264, 1680, True, "jpeg", page_kb=250),
+    "kindle-basic": DeviceProfile("6 inch Kindle", 1072, 1448, True, "jpeg", page_kb=200),
+    "kobo": DeviceProfile("Kobo Clara and Libra", 1264, 1680, True, "jpeg", page_kb=250),
+    "kobo-large": DeviceProfile("Kobo Sage and Elipsa", 1440, 1920, True, "jpeg", page_kb=300),
+    "low-memory": DeviceProfile("Readers with little memory", 800, 1200, True, "jpeg", page_kb=120, book_mb=40),
+    "tablet": DeviceProfile("10 inch tablet", 1600, 2560, False, "jpeg", page_kb=500),
+    "phone": DeviceProfile("Phone", 1080, 2340, False, "jpeg", page_kb=300),
+}
+
+
+def device_options(name: str) -> dict:
+    """
+    :return: the options of the EPubMaker for a device profile
+    """
+    profile = DEVICE_PROFILES[name]
+    return dict(
+        max_width=profile.max_width, max_height=profile.max_height, grayscale=profile.grayscale,
+        output_format=profile.output_format, page_bytes=profile.page_kb and profile.page_kb * 1024,
+        book_bytes=profile.book_mb and profile.book_mb * 1024 * 1024,
+    )
+
+
+def encode(image_data, image_format: str, quality: Optional[int] = None) -> bytes:
+    output = BytesIO()
+    if quality is None:
+        image_data.save(output, format=image_format, optimize=True)
+    else:
+        image_data.save(output, format=image_format, quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def psnr(image_data, data: bytes) -> float:
+    """
+    :return: the peak signal-to-noise ratio of the encoded image data compared to the image, in dB
+    """
+    import PIL.Image
+    import PIL.ImageChops
+    import PIL.ImageStat
+
+    with PIL.Image.open(BytesIO(data)) as encoded:
+        difference = PIL.ImageChops.difference(image_data, encoded.convert(image_data.mode))
+    mse = sum(rms * rms for rms in PIL.ImageStat.Stat(difference).rms) / len(image_data.getbands())
+    return math.inf if mse == 0 else 10 * math.log10(255 * 255 / mse)
+
+
+def encode_to_budget(image_data, image_format: str, max_bytes: int) -> Tuple[bytes, Optional[int]]:
+    """
+    Encode an image in at most max_bytes. The highest JPEG quality that fits is found by bisection, but the quality
+    is raised again if the page would not look like the image anymore, so a page can go over its budget. Other formats
+    have no quality to lower and are only optimized.
+
+    :return: the encoded image and the JPEG quality that was used
+    """
+    if image_format != "JPEG":
+        return encode(image_data, image_format), None
+    low, high = MIN_QUALITY, MAX_QUALITY
+    best: Optional[Tuple[bytes, int]] = None
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode(image_data, image_format, quality)
+        if len(data) <= max_bytes:
+            best = (data, quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best and MIN_PSNR <= psnr(image_data, best[0]):
+        return best
+    # find the lowest quality that still looks like the image
+    low, high = best[1] + 1 if best else MIN_QUALITY, MAX_QUALITY
+    result = None
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode(image_data, image_format, quality)
+        if MIN_PSNR <= psnr(image_data, data):
+            result = (data, quality)
+            high = quality - 1
+        else:
+            low = quality + 1
+    return result or (encode(image_data, image_format, MAX_QUALITY), MAX_QUALITY)
@@ -0,0 +1,141 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+from _Compression import format_size
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+def format_rates(event: dict) -> str:
+    """
+    :return: the speed and the estimated time left of a page event, as shown by the progress bars
+    """
+    return (
+        f"{event['pages_per_second']:.1f} pages/s, {format_size(event['bytes_per_second'])}/s, "
+        f"{format_duration(event['eta'])} left"
+    )
+
+
+class ProgressTracker:
+    """
+    Turns what the EPubMaker does into progress events, which are dicts with an "event" of "phase", "start", "page",
+    or "done". Every event has the name of the book and the time since the tracker was made, and page events have the
+    pages and bytes done so far, the speed, and the estimated time left.
+
+    The events are given to the progress_event method of every sink that has one. The sinks are also given the page
+    count and the pages done through progress_set_maximum and progress_set_value, so sinks that only show a progress
+    bar keep working. Pages may be reported from multiple threads.
+    """
+
+    def __init__(self, *sinks, book=None):
+        self.sinks = [sink for sink in sinks if sink]
+        self.book = book
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.started = None
+        self.pages = 0
+        self.bytes = 0
+        self.pages_done = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def emit(self, event: str, **data):
+        data = dict(event=event, book=self.book, time=time.perf_counter() - self.origin, **data)
+        for sink in self.sinks:
+            progress_event = getattr(sink, "progress_event", None)
+            if progress_event:
+                progress_event(data)
+
+    def phase(self, name):
+        self.emit("phase", phase=name)
+
+    def start(self, pages, size):
+        """
+        Start reporting pages, of which there are the given number with the given total size of their sources.
+        """
+        with self.lock:
+            self.started = time.perf_counter()
+            self.pages, self.bytes = pages, size
+            self.emit("start", pages=pages, bytes=size)
+        for sink in self.sinks:
+            sink.progress_set_maximum(pages)
+            sink.progress_set_value(0)
+
+    def page(self, page_id, bytes_in, bytes_out, seconds):
+        with self.lock:
+            self.pages_done += 1
+            self.bytes_read += bytes_in
+            self.bytes_written += bytes_out
+            elapsed = max(time.perf_counter() - self.started, 1e-9)
+            bytes_per_second = self.bytes_read / elapsed
+            # the sizes of the pages differ more than the time per byte does
+            eta = (self.bytes - self.bytes_read) / bytes_per_second if bytes_per_second else None
+            self.emit(
+                "page", id=page_id, bytes_in=bytes_in, bytes_out=bytes_out, seconds=seconds,
+                pages_done=self.pages_done, pages=self.pages, bytes_read=self.bytes_read,
+                bytes_written=self.bytes_written, pages_per_second=self.pages_done / elapsed,
+                bytes_per_second=bytes_per_second, eta=eta,
+            )
+            pages_done = self.pages_done
+        for sink in self.sinks:
+            sink.progress_set_value(pages_done)
+
+    def done(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.started if self.started else 0.0
+            self.emit(
+                "done", pages=self.pages_done, bytes_read=self.bytes_read, bytes_written=self.bytes_written,
+                seconds=elapsed,
+            )
+
+
+class JsonLinesProgress:
+    """
+    Writes every progress event as a line of JSON to a file. The file is opened for appending and every line is
+    written at once, so multiple books, also in other processes, can write to the same file.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+
+    def progress_event(self, event: dict):
+        line = (json.dumps(event) + "\n").encode("utf-8")
+        with self.lock:
+            fd = os.open(self.file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    def progress_set_maximum(self, value):
+        pass
+
+    def progress_set_value(self, value):
+        pass
@@ -0,0 +1,351 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import json
+import shutil
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import urlsplit, parse_qs, quote
+
+from _Options import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS, check_maker_options
+from _Profiles import OUTPUT_FORMATS, DEVICE_PROFILES, device_options
+from _Sources import is_source
+from _ePubMaker import EPubMaker, RESAMPLE_FILTERS
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def parse_bool(value: str) -> bool:
+    if value.lower() in ("1", "true", "yes", "on"):
+        return True
+    if value.lower() in ("0", "false", "no", "off"):
+        return False
+    raise ValueError(f"{value} is not a boolean")
+
+
+def parse_reducing_gap(value: str) -> Optional[float]:
+    return float(value) or None
+
+
+def parse_resample(value: str) -> str:
+    if value not in RESAMPLE_FILTERS:
+        raise ValueError(f"the resample filter should be one of {', '.join(RESAMPLE_FILTERS)}")
+    return value
+
+
+def parse_eink(value: str) -> str:
+    if value not in OUTPUT_FORMATS:
+        raise ValueError(f"the e-ink format should be one of {', '.join(OUTPUT_FORMATS)}")
+    return value
+
+
+def parse_format(value: str) -> str:
+    if value not in OUTPUT_FORMATS:
+        raise ValueError(f"the format should be one of {', '.join(OUTPUT_FORMATS)}")
+    return value
+
+
+def content_disposition(filename: str) -> str:
+    """
+    :return: the header that makes the response a download of the file name, which is given by the client: the quoted
+        name only has printable ASCII characters other than quotes and backslashes, and the full name is percent-encoded
+    """
+    fallback = "".join(char if " " <= char <= "~" and char not in '"\\' else "_" for char in filename)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+# the options of the EPubMaker that can be given per job, and how their values are parsed, after which their ranges
+# are checked like those of the command line
+JOB_OPTIONS = {
+    "grayscale": parse_bool, "max_width": int, "max_height": int, "wrap_pages": parse_bool, "resample": parse_resample,
+    "reducing_gap": parse_reducing_gap, "compression_level": int, "compression_sample": parse_bool,
+    "dedup": parse_bool, "dedup_threshold": int, "eink": parse_eink, "gamma": float, "black_point": int,
+    "white_point": int, "dither": parse_bool, "output_format": parse_format, "page_bytes": int, "book_bytes": int,
+    "strips": parse_bool, "crop": parse_bool, "crop_tolerance": int, "crop_margin": float, "crop_spreads": parse_bool,
+}
+
+
+class Job:
+    """
+    A conversion requested through the server. It receives the progress of its EPubMaker like the progress bars do.
+    """
+
+    def __init__(self, work_dir: Path, input_dir, name, options: dict, upload: Optional[Path] = None):
+        self.id = uuid.uuid4().hex
+        self.dir = work_dir.joinpath(self.id)
+        self.dir.mkdir()
+        self.input_dir = input_dir
+        self.upload = upload
+        self.name = name
+        self.options = options
+        if options.get("profile"):
+            # jobs run at the same time, so every job has its own profile
+            self.options = dict(options, profile=f"{options['profile']}.{self.id}")
+        self.file = self.dir.joinpath("output.epub")
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.value = 0
+        self.maximum = 0
+        self.maker: Optional[EPubMaker] = None
+        self.cancelled = False
+        self.removed = False
+        self.phase = None
+        self.rates = {}
+
+    def progress_set_value(self, value):
+        self.value = value
+
+    def progress_set_maximum(self, value):
+        self.maximum = value
+
+    def progress_event(self, event):
+        if event["event"] == "phase":
+            self.phase = event["phase"]
+        elif event["event"] == "page":
+            self.rates = {
+                key: event[key] for key in ("bytes_read", "bytes_written", "pages_per_second", "bytes_per_second", "eta")
+            }
+
+    def run(self):
+        if self.cancelled:
+            return
+        self.status = "running"
+        try:
+            self.maker = EPubMaker(
+                master=None, input_dir=self.input_dir, file=str(self.file), name=self.name, progress=self,
+                **self.options
+            )
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e)
+        else:
+            if self.cancelled:
+                # the job was cancelled while its maker was made, before cancel could stop it
+                self.maker.stop()
+            self.maker.run()
+            if self.maker.error:
+                self.status = "cancelled" if self.cancelled else "failed"
+                self.error = str(self.maker.error)
+            else:
+                self.status = "done"
+        if self.removed:
+            self.remove_files()
+
+    def remove_files(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+        if self.upload and self.upload.exists():
+            self.upload.unlink()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.maker:
+            self.maker.stop()
+        elif self.status == "queued":
+            self.status = "cancelled"
+
+    def to_json(self) -> dict:
+        return {
+            "id": self.id, "name": self.name, "status": self.status, "error": self.error,
+            "progress": dict(self.rates, value=self.value, maximum=self.maximum, phase=self.phase),
+        }
+
+
+class ConversionServer(ThreadingHTTPServer):
+    """
+    Makes ePubs for requests to a local HTTP API, so other programs do not have to start a new process for every
+    book. The jobs are queued and made by a fixed number of workers, with the given options of the EPubMaker as
+    defaults:
+
+    POST /jobs?dir=DIRECTORY&name=NAME&option=value starts a job for a directory or archive on this machine, where
+    device=DEVICE gives the options of a device profile
+    POST /jobs?name=NAME&option=value with a zip or tar archive as body starts a job for the uploaded archive
+    GET /jobs lists the jobs, and GET /jobs/ID gives the status and progress of a job
+    GET /jobs/ID/epub returns the ePub of a finished job
+    DELETE /jobs/ID cancels a job and removes its files
+    """
+    daemon_threads = True
+
+    def __init__(self, address, maker_options: dict, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE):
+        super().__init__(address, RequestHandler)
+        self.maker_options = maker_options
+        self.workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.queue_size = queue_size
+        self.work_dir = Path(tempfile.mkdtemp(prefix="images_to_epub_server_"))
+        self.jobs: Dict[str, Job] = {}
+        self.lock = threading.Lock()
+
+    def queue_is_full(self) -> bool:
+        return self.queue_size <= sum(job.status == "queued" for job in self.jobs.values())
+
+    def add_job(self, input_dir, name, options: dict, upload: Optional[Path] = None) -> Optional[Job]:
+        """
+        :return: the queued job, or None if the queue is full
+        """
+        with self.lock:
+            if self.queue_is_full():
+                return None
+            job = Job(self.work_dir, input_dir, name, dict(self.maker_options, **options), upload)
+            self.jobs[job.id] = job
+        self.workers.submit(job.run)
+        return job
+
+    def remove_job(self, job: Job):
+        with self.lock:
+            del self.jobs[job.id]
+        job.removed = True
+        job.cancel()
+        # the files of a running job are removed by the job once it stopped
+        if job.status != "running":
+            job.remove_files()
+
+    def server_close(self):
+        super().server_close()
+        for job in list(self.jobs.values()):
+            job.cancel()
+        self.workers.shutdown(wait=True)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server: ConversionServer
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {"error": message})
+
+    def find_job(self, parts) -> Optional[Job]:
+        job = self.server.jobs.get(parts[1]) if 2 <= len(parts) else None
+        if job is None:
+            self.send_error_json(404, "Unknown job")
+        return job
+
+    def do_GET(self):
+        parts = [part for part in urlsplit(self.path).path.split("/") if part]
+        if parts == ["jobs"]:
+            self.send_json(200, [job.to_json() for job in list(self.server.jobs.values())])
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self.find_job(parts)
+            if job:
+                self.send_json(200, job.to_json())
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "epub":
+            job = self.find_job(parts)
+            if not job:
+                return
+            if job.status != "done":
+                self.send_error_json(409, f"The job is {job.status}")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/epub+zip")
+            self.send_header("Content-Length", str(job.file.stat().st_size))
+            self.send_header("Content-Disposition", content_disposition(f"{job.name}.epub"))
+            self.end_headers()
+            with open(job.file, 'rb') as file:
+                shutil.copyfileobj(file, self.wfile)
+        else:
+            self.send_error_json(404, "Not found")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path.strip("/") != "jobs":
+            self.send_error_json(404, "Not found")
+            return
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        device = query.pop("device", None)
+        if device and device not in DEVICE_PROFILES:
+            self.send_error_json(400, f"Unknown device, use one of {', '.join(DEVICE_PROFILES)}")
+            return
+        try:
+            options = dict(
+                device_options(device) if device else {},
+                **{key: JOB_OPTIONS[key](value) for key, value in query.items() if key not in ("dir", "name")}
+            )
+            check_maker_options(dict(self.server.maker_options, **options))
+        except KeyError as e:
+            self.send_error_json(400, f"Unknown option {e}")
+            return
+        except ValueError as e:
+            self.send_error_json(400, f"Invalid option: {e}")
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        input_dir = query.get("dir")
+        if bool(input_dir) == bool(length):
+            self.send_error_json(400, "Give either a dir or an archive as body")
+            return
+        if input_dir and not is_source(input_dir):
+            self.send_error_json(400, "The dir is not a directory or archive")
+            return
+        name = query.get("name") or (Path(input_dir).stem if input_dir else "Output")
+        if self.server.queue_is_full():
+            self.send_error_json(503, "The queue is full")
+            return
+
+        upload = None
+        if length:
+            upload = Path(tempfile.mkstemp(prefix="upload_", dir=self.server.work_dir)[1])
+            with open(upload, 'wb') as file:
+                while length:
+                    chunk = self.rfile.read(min(length, UPLOAD_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    file.write(chunk)
+                    length -= len(chunk)
+            if not is_source(upload):
+                upload.unlink()
+                self.send_error_json(400, "The body is not a zip or tar archive")
+                return
+
+        job = self.server.add_job(str(upload or input_dir), name, options, upload)
+        if job is None:
+            if upload:
+                upload.unlink()
+            self.send_error_json(503, "The queue is full")
+            return
+        self.send_json(202, job.to_json())
+
+    def do_DELETE(self):
+        parts = [part for part in urlsplit(self.path).path.split("/") if part]
+        if len(parts) != 2 or parts[0] != "jobs":
+            self.send_error_json(404, "Not found")
+            return
+        job = self.find_job(parts)
+        if job:
+            self.server.remove_job(job)
+            self.send_json(200, job.to_json())
+
+
+def serve(port, maker_options: dict, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, host="127.0.0.1"):
+    server = ConversionServer((host, port), maker_options, workers, queue_size)
+    print(f"Serving on http://{host}:{server.server_port}/jobs with {workers} workers, press Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped serving")
+    finally:
+        server.server_close()
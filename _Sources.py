@@ -0,0 +1,194 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import os
+import tarfile
+import threading
+import zipfile
+from datetime import datetime
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, Tuple
+
+from _ZipTools import can_copy_raw
+
+IGNORED_DIRECTORIES = {"__MACOSX"}
+
+
+def open_source(path):
+    """
+    :return: the source of the images at the path, which is either a directory or a zip (cbz) or tar archive
+    """
+    if os.path.isdir(path):
+        return DirectorySource(path)
+    if zipfile.is_zipfile(path):
+        return ZipSource(path)
+    if tarfile.is_tarfile(path):
+        return TarSource(path)
+    raise ValueError(f"{path} is not a directory, zip archive, or tar archive")
+
+
+def is_source(path) -> bool:
+    return os.path.isdir(path) or (os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path)))
+
+
+class DirectorySource:
+    """
+    The images in a directory. The paths of the images are the paths of the files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        pass
+
+    def walk(self):
+        return os.walk(self.path)
+
+    def stat(self, source) -> Tuple[int, int]:
+        """
+        :return: the size and the modification time in nanoseconds of the image
+        """
+        stat = os.stat(source)
+        return stat.st_size, stat.st_mtime_ns
+
+    def open(self, source):
+        return open(source, 'rb')
+
+    def read(self, source) -> bytes:
+        with self.open(source) as file:
+            return file.read()
+
+    def transcode_input(self, source):
+        """
+        :return: what is given to a worker process to open the image, so the path or the content of the image
+        """
+        return source
+
+    def write(self, source, archive: zipfile.ZipFile, name, compression, file_type):
+        """
+        Write the image as-is to the archive.
+        """
+        compression.write(archive, name, source=source, file_type=file_type)
+
+
+class ArchiveSource(DirectorySource):
+    """
+    The images in an archive. The paths of the images are the path of the archive joined with the names of the
+    members, and the folders in the archive are walked as if they were directories.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.root = str(Path(path))
+        self.members: Dict[str, object] = {}
+
+    def add_member(self, name, member):
+        parts = [part for part in name.split('/') if part]
+        if parts and not IGNORED_DIRECTORIES.intersection(parts):
+            self.members[str(Path(self.root).joinpath(*parts))] = member
+
+    def walk(self):
+        children: Dict[str, Tuple[set, list]] = {self.root: (set(), [])}
+        for source in self.members:
+            path = Path(source)
+            children.setdefault(str(path.parent), (set(), []))[1].append(path.name)
+            while str(path.parent) != self.root:
+                path = path.parent
+                children.setdefault(str(path.parent), (set(), []))[0].add(path.name)
+                children.setdefault(str(path), (set(), []))
+
+        def walk(dir_path):
+            dir_names, filenames = children[dir_path]
+            dir_names = list(dir_names)
+            # like os.walk, the caller may sort or remove the directory names before they are walked
+            yield dir_path, dir_names, list(filenames)
+            for dir_name in dir_names:
+                yield from walk(str(Path(dir_path).joinpath(dir_name)))
+
+        return walk(self.root)
+
+    def open(self, source):
+        return BytesIO(self.read(source))
+
+    def transcode_input(self, source):
+        return self.read(source)
+
+    def write(self, source, archive: zipfile.ZipFile, name, compression, file_type):
+        compression.write(archive, name, self.read(source), file_type=file_type)
+
+
+class ZipSource(ArchiveSource):
+    def __init__(self, path):
+        super().__init__(path)
+        self.archive = zipfile.ZipFile(path)
+        for info in self.archive.infolist():
+            if not info.is_dir():
+                self.add_member(info.filename, info)
+
+    def close(self):
+        self.archive.close()
+
+    def stat(self, source) -> Tuple[int, int]:
+        info: zipfile.ZipInfo = self.members[source]
+        return info.file_size, int(datetime(*info.date_time).timestamp() * 1e9)
+
+    def open(self, source):
+        return self.archive.open(self.members[source])
+
+    def read(self, source) -> bytes:
+        return self.archive.read(self.members[source])
+
+    def write(self, source, archive: zipfile.ZipFile, name, compression, file_type):
+        """
+        Copy the member without decompressing it, so it keeps the compression it has in the source archive. Members
+        that are compressed in a way an ePub does not allow, like BZIP2 or LZMA, are compressed again.
+        """
+        info = self.members[source]
+        if can_copy_raw(info):
+            compression.copy(self.archive, info.filename, archive, name)
+        else:
+            compression.write(archive, name, self.read(source), file_type=file_type)
+
+
+class TarSource(ArchiveSource):
+    def __init__(self, path):
+        super().__init__(path)
+        self.archive = tarfile.open(path)
+        # a tar file can not be read by multiple threads at the same time
+        self.lock = threading.Lock()
+        for info in self.archive.getmembers():
+            if info.isfile():
+                self.add_member(info.name, info)
+
+    def close(self):
+        self.archive.close()
+
+    def stat(self, source) -> Tuple[int, int]:
+        info: tarfile.TarInfo = self.members[source]
+        return info.size, int(info.mtime * 1e9)
+
+    def read(self, source) -> bytes:
+        with self.lock:
+            return self.archive.extractfile(self.members[source]).read()
@@ -0,0 +1,249 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import struct
+import zlib
+from array import array
+from io import BytesIO
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+# an image that is at least this many pages tall is a strip, like a chapter of a webtoon, which is cut in pages
+STRIP_PAGES = 2
+# the height of a page compared to its width, if the maximum width and height do not tell
+DEFAULT_PAGE_RATIO = 1.5
+# a page of a strip is cut between this part of a page and a full page, at the rows with the least content
+MIN_TILE_PART = 0.5
+# the number of rows that are decoded at a time, so a strip is never decoded in full
+BAND_HEIGHT = 1024
+# a row of which the pixels differ on average less than this from the pixels left of them is blank, like the space
+# between two panels, even with the noise of JPEG compression
+BLANK_ROW_SCORE = 1.0
+# the number of bytes of the compressed image data that are read at a time
+READ_SIZE = 64 * 1024
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# the modes of PNG images with 8 bits per channel by color type, which PIL decodes to the bytes of their rows as-is
+PNG_MODES = {0: "L", 2: "RGB", 3: "P", 4: "LA", 6: "RGBA"}
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# the chunks other than the image data that are needed to decode the rows of a PNG image
+BAND_CHUNKS = (b"PLTE", b"tRNS")
+
+
+class PngHeader(NamedTuple):
+    width: int
+    height: int
+    bit_depth: int
+    color_type: int
+    interlace: int
+
+    @property
+    def streamable(self) -> bool:
+        """
+        :return: whether the image can be decoded a band at a time
+        """
+        return self.bit_depth == 8 and self.color_type in PNG_MODES and not self.interlace
+
+
+def page_ratio(max_width: Optional[int], max_height: Optional[int]) -> float:
+    return max_height / max_width if max_width and max_height else DEFAULT_PAGE_RATIO
+
+
+def is_strip(info, ratio: float) -> bool:
+    return STRIP_PAGES * tile_height(info.width, ratio) <= info.height
+
+
+def tile_height(width: int, ratio: float) -> int:
+    """
+    :return: the height of a page of a strip with the width
+    """
+    return max(1, round(width * ratio))
+
+
+def png_header(file) -> Optional[PngHeader]:
+    """
+    :return: the header of the PNG image, or None if the file is not a PNG image
+    """
+    if file.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        return None
+    length, chunk_type = struct.unpack(">I4s", file.read(8))
+    if chunk_type != b"IHDR" or length != 13:
+        return None
+    width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">2I5B", file.read(13))
+    file.read(4)
+    return PngHeader(width, height, bit_depth, color_type, interlace)
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+def decode_rows(header: PngHeader, chunks: List[bytes], rows: bytes, count: int, previous: Optional[bytes]):
+    """
+    Decode rows of a PNG image by making a PNG image of just these rows. A row is filtered with the row above it, so
+    the decoded row above the first row is added as a row of its own, without a filter, and cut off again.
+    """
+    import PIL.Image
+
+    if previous is not None:
+        rows = b"\0" + previous + rows
+        count += 1
+    data = b"".join([
+        PNG_SIGNATURE, png_chunk(b"IHDR", struct.pack(">2I5B", header.width, count, 8, header.color_type, 0, 0, 0)),
+        *chunks, png_chunk(b"IDAT", zlib.compress(rows, 0)), png_chunk(b"IEND", b""),
+    ])
+    band = PIL.Image.open(BytesIO(data))
+    band.load()
+    return band if previous is None else band.crop((0, 1, header.width, count))
+
+
+def png_bands(file, header: PngHeader, band_height: int):
+    """
+    Decode a PNG image of which the header was read a band at a time, decompressing only the image data of the band.
+    """
+    stride = (header.width * PNG_CHANNELS[header.color_type] * header.bit_depth + 7) // 8 + 1
+    chunks = []
+    decompressor = zlib.decompressobj()
+    rows = bytearray()
+    previous = None
+    top = 0
+    while top < header.height:
+        length, chunk_type = struct.unpack(">I4s", file.read(8))
+        if chunk_type == b"IEND":
+            raise ValueError("The PNG image ends before its last row")
+        if chunk_type != b"IDAT":
+            data = file.read(length)
+            if chunk_type in BAND_CHUNKS:
+                chunks.append(png_chunk(chunk_type, data))
+            file.read(4)
+            continue
+        remaining = length
+        while remaining and top < header.height:
+            data = file.read(min(remaining, READ_SIZE))
+            if not data:
+                raise ValueError("The PNG image ends before its last row")
+            remaining -= len(data)
+            while data:
+                # a few bytes of compressed data can hold many rows, so they are decompressed a band at a time
+                rows += decompressor.decompress(data, band_height * stride)
+                data = decompressor.unconsumed_tail
+                count = min(band_height, header.height - top)
+                while top < header.height and count * stride <= len(rows):
+                    band = decode_rows(header, chunks, bytes(rows[:count * stride]), count, previous)
+                    del rows[:count * stride]
+                    previous = band.crop((0, band.height - 1, band.width, band.height)).tobytes()
+                    top += count
+                    count = min(band_height, header.height - top)
+                    yield band
+        file.read(remaining + 4)
+
+
+def open_bands(source, gray=False, band_height=BAND_HEIGHT) -> Tuple[str, Iterator]:
+    """
+    Decode an image in bands of band_height rows from the top. PNG images with 8 bits per channel that are not
+    interlaced are decoded a band at a time, so only a band is in memory. Other images are decoded in full, which is
+    done in grayscale for JPEG images if gray is given.
+
+    :param source: the path or the content of the image
+    :return: the format of the image in PIL, and the bands
+    """
+    import PIL.Image
+
+    file = BytesIO(source) if isinstance(source, bytes) else open(source, 'rb')
+    header = png_header(file)
+    if header and header.streamable:
+        def bands():
+            with file:
+                yield from png_bands(file, header, band_height)
+
+        return "PNG", bands()
+
+    file.seek(0)
+    image_data = PIL.Image.open(file)
+    if gray and image_data.format == "JPEG":
+        image_data.draft("L", image_data.size)
+
+    def bands():
+        with file, image_data:
+            image_data.load()
+            for top in range(0, image_data.height, band_height):
+                yield image_data.crop((0, top, image_data.width, min(top + band_height, image_data.height)))
+
+    return image_data.format, bands()
+
+
+def row_scores(band) -> List[float]:
+    """
+    :return: the content of every row of the band, as the average difference of its pixels with the pixels left of them
+    """
+    import PIL.Image
+    import PIL.ImageChops
+
+    gray = band.convert("L")
+    width, height = gray.size
+    if width < 2:
+        return [0.0] * height
+    difference = PIL.ImageChops.difference(gray.crop((1, 0, width, height)), gray.crop((0, 0, width - 1, height)))
+    return list(difference.convert("F").resize((1, height), PIL.Image.BOX).getdata())
+
+
+def best_cut(scores: Sequence[float], start: int, end: int) -> int:
+    """
+    :return: the row from start to end at which a page is cut: the middle of the longest run of blank rows, or
+        else the row with the least content, preferring the rows closest to end
+    """
+    best, run_start = None, None
+    for row in range(start, end + 2):
+        if row <= end and scores[row] <= BLANK_ROW_SCORE:
+            if run_start is None:
+                run_start = row
+        elif run_start is not None:
+            if best is None or best[1] - best[0] <= row - run_start:
+                best = (run_start, row)
+            run_start = None
+    if best:
+        return (best[0] + best[1]) // 2
+    return min(range(start, end + 1), key=lambda row: (scores[row], -row))
+
+
+def find_cuts(scores: Sequence[float], height: int) -> List[int]:
+    """
+    :param scores: the content of every row of a strip
+    :param height: the height of a page
+    :return: the rows at which the strip is cut, starting with 0 and ending with the height of the strip, so page i
+        has the rows from cuts[i] up to cuts[i + 1]
+    """
+    cuts = [0]
+    while height < len(scores) - cuts[-1]:
+        top = cuts[-1]
+        cuts.append(best_cut(scores, top + max(1, int(height * MIN_TILE_PART)), top + height))
+    return cuts + [len(scores)]
+
+
+def even_cuts(strip_height: int, height: int) -> List[int]:
+    """
+    :return: the rows at which a strip would be cut in pages of the height, without looking at its content
+    """
+    return list(range(0, strip_height, height)) + [strip_height]
+
+
+def strip_cuts(source, height: int) -> List[int]:
+    """
+    Decode a strip in bands to find the rows at which it is cut in pages of at most height rows.
+    """
+    scores = array("f")
+    for band in open_bands(source)[1]:
+        scores.extend(row_scores(band))
+    return find_cuts(scores, height)
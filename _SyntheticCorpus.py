@@ -0,0 +1,126 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import json
+import random
+import shutil
+from pathlib import Path
+from typing import NamedTuple, Tuple, List
+
+import PIL.Image
+import PIL.ImageDraw
+
+FORMATS = {"jpeg": ".jpg", "png": ".png", "gif": ".gif"}
+SPEC_FILE = "corpus.json"
+
+
+class CorpusSpec(NamedTuple):
+    pages: int = 50
+    width: int = 1600
+    height: int = 2400
+    formats: Tuple[str, ...] = ("jpeg",)
+    # the number of levels of nested chapters, and the number of chapters in every level
+    depth: int = 1
+    chapters: int = 4
+    color: bool = True
+    seed: int = 0
+
+    @property
+    def name(self) -> str:
+        return (
+            f"{self.pages}p_{self.width}x{self.height}_{'-'.join(self.formats)}_d{self.depth}x{self.chapters}_"
+            f"{'color' if self.color else 'gray'}_s{self.seed}"
+        )
+
+
+def chapter_directories(root: Path, depth, chapters) -> List[Path]:
+    """
+    :return: the directories of the deepest chapters, in reading order
+    """
+    directories = [root]
+    for level in range(depth):
+        label = "Chapter" if level == 0 else "Part"
+        directories = [
+            directory.joinpath(f"{label} {index}") for directory in directories for index in range(1, chapters + 1)
+        ]
+    return directories
+
+
+def draw_page(spec: CorpusSpec, number, rng: random.Random) -> PIL.Image.Image:
+    """
+    Draw a page that looks a bit like a comic: panels with borders, lines, and shaded areas.
+    """
+    mode = "RGB" if spec.color else "L"
+
+    def color():
+        if spec.color:
+            return rng.randrange(256), rng.randrange(256), rng.randrange(256)
+        return rng.randrange(256)
+
+    image = PIL.Image.new(mode, (spec.width, spec.height), (255, 255, 255) if spec.color else 255)
+    draw = PIL.ImageDraw.Draw(image)
+    margin = spec.width // 20
+    rows = rng.randint(2, 4)
+    panel_height = (spec.height - margin) // rows
+    for row in range(rows):
+        columns = rng.randint(1, 3)
+        panel_width = (spec.width - margin) // columns
+        for column in range(columns):
+            box = (
+                margin + column * panel_width, margin + row * panel_height,
+                (column + 1) * panel_width, (row + 1) * panel_height,
+            )
+            draw.rectangle(box, fill=color(), outline=0 if not spec.color else (0, 0, 0), width=max(1, margin // 8))
+            for _ in range(20):
+                draw.line(
+                    (rng.randint(box[0], box[2]), rng.randint(box[1], box[3]),
+                     rng.randint(box[0], box[2]), rng.randint(box[1], box[3])),
+                    fill=color(), width=rng.randint(1, 6)
+                )
+            x, y = rng.randint(box[0], box[2]), rng.randint(box[1], box[3])
+            radius = rng.randint(margin // 2, margin * 2)
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color())
+    draw.text((margin, margin // 3), f"Page {number}", fill=0 if not spec.color else (0, 0, 0))
+    return image
+
+
+def generate_corpus(spec: CorpusSpec, directory) -> Path:
+    """
+    Generate the images of a corpus in a subdirectory of the given directory. A corpus that was already generated with
+    the same spec is reused.
+
+    :return: the directory of the corpus
+    """
+    root = Path(directory).joinpath(spec.name)
+    spec_file = root.joinpath(SPEC_FILE)
+    if spec_file.is_file() and spec_file.read_text() == json.dumps(list(spec)):
+        return root
+    if root.exists():
+        shutil.rmtree(root)
+
+    rng = random.Random(spec.seed)
+    directories = chapter_directories(root, spec.depth, spec.chapters)
+    for number in range(1, spec.pages + 1):
+        directory = directories[(number - 1) * len(directories) // spec.pages]
+        directory.mkdir(parents=True, exist_ok=True)
+        image_format = spec.formats[(number - 1) % len(spec.formats)]
+        image = draw_page(spec, number, rng)
+        if image_format == "gif":
+            image = image.convert("P")
+        image.save(directory.joinpath(f"{number:05}{FORMATS[image_format]}"), format=image_format)
+    spec_file.write_text(json.dumps(list(spec)))
+    return root
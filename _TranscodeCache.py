@@ -0,0 +1,146 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+CACHE_VERSION = 1
+INDEX_FILE = "index.json"
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+# unique per process and thread, as other runs may write the same files at the same time
+TEMP_SUFFIX = ".{}.{}.tmp"
+
+
+def hash_file(source, chunk_size=1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(source, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_source(source) -> str:
+    """
+    :param source: the path or the content of an image
+    """
+    return hashlib.sha256(source).hexdigest() if isinstance(source, bytes) else hash_file(source)
+
+
+class TranscodeCache:
+    """
+    An on-disk cache with the results of transcoding images. The key of an entry is the hash of the content of the
+    source combined with the transform settings, so renaming or touching a source does not invalidate the entry.
+    The least recently used entries are removed when the cache grows beyond max_size bytes.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.index = self.load_index()
+        self.hits = 0
+        self.misses = 0
+
+    def load_index(self) -> dict:
+        try:
+            with open(self.directory.joinpath(INDEX_FILE), encoding='utf-8') as file:
+                index = json.load(file)
+        except (IOError, ValueError):
+            return {}
+        if index.get("version") != CACHE_VERSION:
+            return {}
+        return index["entries"]
+
+    def make_key(self, source, settings) -> str:
+        """
+        :param source: the path or the content of the image
+        """
+        return hashlib.sha256(f"{CACHE_VERSION}:{hash_source(source)}:{tuple(settings)!r}".encode()).hexdigest()
+
+    def entry_path(self, key) -> Path:
+        return self.directory.joinpath(key[:2], key + ".bin")
+
+    def get(self, key) -> Optional[Tuple[Optional[bytes], int, int, str, Optional[int]]]:
+        """
+        :return: the data, width, height, mimetype, and perceptual hash of the entry, or None if the key is not in the
+            cache
+        """
+        entry = self.index.get(key)
+        data = None
+        if entry and entry["size"]:
+            try:
+                data = self.entry_path(key).read_bytes()
+            except IOError:
+                entry = None
+        if not entry:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry["last_used"] = time.time()
+        return data, entry["width"], entry["height"], entry["type"], entry.get("phash")
+
+    def put(self, key, data: Optional[bytes], width, height, file_type, phash=None):
+        """
+        Store a result in the cache. The data may be None for images that are copied as-is, in which case only the
+        metadata is stored. The perceptual hash is only known if it was asked for.
+        """
+        if data:
+            path = self.entry_path(key)
+            path.parent.mkdir(exist_ok=True)
+            temp_path = path.with_suffix(TEMP_SUFFIX.format(os.getpid(), threading.get_ident()))
+            temp_path.write_bytes(data)
+            os.replace(temp_path, path)
+        self.index[key] = {
+            "size": len(data) if data else 0, "width": width, "height": height, "type": file_type, "phash": phash,
+            "last_used": time.time(),
+        }
+
+    def save(self):
+        """
+        Merge the index with the one on disk, which could be changed by another run, remove the least recently used
+        entries until the cache fits in max_size, and write the index.
+        """
+        for key, entry in self.load_index().items():
+            current = self.index.setdefault(key, entry)
+            current["last_used"] = max(current["last_used"], entry["last_used"])
+
+        total = sum(entry["size"] for entry in self.index.values())
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_size:
+                break
+            total -= entry["size"]
+            del self.index[key]
+            try:
+                os.remove(self.entry_path(key))
+            except IOError:
+                pass
+
+        index_path = self.directory.joinpath(INDEX_FILE)
+        temp_path = index_path.with_suffix(TEMP_SUFFIX.format(os.getpid(), threading.get_ident()))
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({"version": CACHE_VERSION, "entries": self.index}, file)
+        os.replace(temp_path, index_path)
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return f"Cache: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate)"
@@ -0,0 +1,194 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from _BatchScheduler import BatchScheduler
+from _Options import DEFAULT_SETTLE
+
+DEFAULT_POLL_INTERVAL = 5.0
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class PollingMonitor:
+    """
+    Finds the books that changed by comparing the sizes and modification times of their files every interval seconds.
+    """
+
+    def __init__(self, books: List[Path], interval=DEFAULT_POLL_INTERVAL):
+        self.interval = interval
+        self.signatures = {book: self.signature(book) for book in books}
+
+    @staticmethod
+    def signature(book: Path):
+        result = []
+        for dir_path, dir_names, filenames in os.walk(book):
+            for name in dir_names + filenames:
+                try:
+                    stat = os.stat(os.path.join(dir_path, name))
+                except OSError:
+                    continue
+                result.append((dir_path, name, stat.st_size, stat.st_mtime_ns))
+        result.sort()
+        return result
+
+    def wait(self, timeout: Optional[float]) -> Set[Path]:
+        """
+        :return: the books that changed within the timeout, or within the interval if that is shorter
+        """
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        changed = set()
+        for book, old in self.signatures.items():
+            new = self.signature(book)
+            if new != old:
+                self.signatures[book] = new
+                changed.add(book)
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyMonitor:
+    """
+    Finds the books that changed with inotify, so nothing is done while the books do not change. Only available on
+    Linux. Every directory of the books is watched, and directories that are created later on are added as they come.
+    """
+
+    def __init__(self, books: List[Path]):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.books = books
+        self.watches: Dict[int, tuple] = {}
+        for book in books:
+            self.add_tree(book, book)
+
+    def add_tree(self, book: Path, directory: Path):
+        for dir_path, _, _ in os.walk(directory):
+            watch = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+            if 0 <= watch:
+                self.watches[watch] = (book, Path(dir_path))
+
+    def wait(self, timeout: Optional[float]) -> Set[Path]:
+        """
+        :return: the books that changed within the timeout
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            watch, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, so any book may have changed
+                changed.update(self.books)
+                continue
+            book, directory = self.watches.get(watch, (None, None))
+            if book is None:
+                continue
+            changed.add(book)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # files may already be written to the new directory before it is watched, which the rebuild finds
+                self.add_tree(book, directory.joinpath(os.fsdecode(name)))
+            if mask & IN_DELETE_SELF:
+                del self.watches[watch]
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_monitor(books: List[Path], poll_interval: Optional[float] = None):
+    """
+    :return: an inotify monitor if it is available and no poll interval is given, otherwise a polling monitor
+    """
+    if poll_interval is None and sys.platform.startswith("linux"):
+        try:
+            return InotifyMonitor(books)
+        except (OSError, AttributeError) as e:
+            print(f"Could not use inotify ({e}), polling instead", file=sys.stderr)
+    return PollingMonitor(books, poll_interval or DEFAULT_POLL_INTERVAL)
+
+
+class Watcher:
+    """
+    Makes the books of a batch and keeps them up to date: when the files of a book change, the book is updated once
+    it did not change for settle seconds, so a chapter that is being copied is only added when it is complete. The
+    existing ePub is updated, so only new and changed pages are converted.
+    """
+
+    def __init__(self, directories: List[Path], maker_options: dict, settle=DEFAULT_SETTLE, poll_interval=None,
+                 **scheduler_options):
+        self.books = [directory.resolve() for directory in directories]
+        self.maker_options = maker_options
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.scheduler_options = scheduler_options
+
+    def build(self, books: List[Path], force=False):
+        BatchScheduler(books, self.maker_options, force=force, **self.scheduler_options).run()
+
+    def run(self, force=False):
+        monitor = make_monitor(self.books, self.poll_interval)
+        try:
+            self.build(self.books, force)
+            print(f"Watching {len(self.books)} books for changes, press Ctrl+C to stop")
+            # the time after which a changed book is considered stable
+            stable_at: Dict[Path, float] = {}
+            while True:
+                timeout = max(0.0, min(stable_at.values()) - time.monotonic()) if stable_at else None
+                for book in monitor.wait(timeout):
+                    stable_at[book] = time.monotonic() + self.settle
+                now = time.monotonic()
+                stable = [book for book, moment in stable_at.items() if moment <= now]
+                if stable:
+                    for book in stable:
+                        del stable_at[book]
+                    print(f"\nUpdating {', '.join(book.name for book in stable)}")
+                    self.build(stable)
+        except KeyboardInterrupt:
+            print("\nStopped watching")
+        finally:
+            monitor.close()
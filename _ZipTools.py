@@ -0,0 +1,140 @@
+# coding=utf-8
+""" Convert a folder with images to an ePub file. Great for comics and manga!
+    Copyright (C) 2021  Antoine Veenstra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see [http://www.gnu.org/licenses/]
+"""
+import struct
+import time
+import zlib
+from zipfile import ZipFile, ZipInfo, BadZipFile, ZIP_STORED, ZIP_DEFLATED
+
+LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+LOCAL_HEADER_SIZE = 30
+LOCAL_HEADER_FORMAT = "<4s2B4HL2L2H"
+ENCRYPTED_FLAG = 0x01
+DATA_DESCRIPTOR_FLAG = 0x08
+UTF8_FLAG = 0x800
+
+
+def can_copy_raw(info: ZipInfo) -> bool:
+    """
+    :return: whether the member can be copied as it is stored into an ePub, which only allows members that are stored
+        or deflated, and not encrypted
+    """
+    return info.compress_type in (ZIP_STORED, ZIP_DEFLATED) and not info.flag_bits & ENCRYPTED_FLAG
+
+
+def read_raw(archive: ZipFile, info: ZipInfo) -> bytes:
+    """
+    Read the data of a member as it is stored in the archive, so without decompressing it.
+    """
+    archive.fp.seek(info.header_offset)
+    header = archive.fp.read(LOCAL_HEADER_SIZE)
+    if header[:4] != LOCAL_HEADER_SIGNATURE:
+        raise BadZipFile(f"Bad local file header for {info.filename}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    archive.fp.seek(name_length + extra_length, 1)
+    return archive.fp.read(info.compress_size)
+
+
+def write_raw(archive: ZipFile, info: ZipInfo, name: str, data: bytes):
+    """
+    Add a member to the archive of which the data is already compressed, for example data returned by read_raw. The
+    info describes the data, so the compression type, CRC, and sizes are copied from it.
+    """
+    member = ZipInfo(name, info.date_time)
+    member.compress_type = info.compress_type
+    member.CRC = info.CRC
+    member.compress_size = info.compress_size
+    member.file_size = info.file_size
+    member.external_attr = info.external_attr
+    member.flag_bits = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    member.header_offset = archive.fp.tell()
+    archive.fp.write(member.FileHeader())
+    archive.fp.write(data)
+    archive.filelist.append(member)
+    archive.NameToInfo[name] = member
+    archive.start_dir = archive.fp.tell()
+
+
+def write_stored(archive: ZipFile, name: str, data: bytes):
+    """
+    Add a member that is not compressed, with its CRC and size in its local header. ZipFile.writestr gives every
+    member written to a stream that is not seekable a data descriptor instead, with the size after the data.
+    """
+    info = ZipInfo(name, time.localtime(time.time())[:6])
+    info.compress_type = ZIP_STORED
+    info.CRC = zlib.crc32(data)
+    info.compress_size = info.file_size = len(data)
+    info.external_attr = 0o600 << 16
+    write_raw(archive, info, name, data)
+
+
+def is_stream(file) -> bool:
+    """
+    :return: whether the file is a file object that is written to, like a pipe or a buffer, rather than a path
+    """
+    return hasattr(file, "write")
+
+
+def copy_raw(source: ZipFile, name: str, target: ZipFile, target_name: str = None):
+    """
+    Copy a member from one archive to another without decompressing and compressing it again.
+    """
+    info = source.getinfo(name)
+    write_raw(target, info, target_name or name, read_raw(source, info))
+
+
+def recover(file, end: int):
+    """
+    Make a zip file of which the writing was interrupted readable again. The members before the offset end, which
+    should be known to be complete, are kept and a central directory is written for them.
+    """
+    with open(file, 'r+b') as fp:
+        fp.truncate(end)
+        members = []
+        offset = 0
+        while offset < end:
+            fp.seek(offset)
+            header = fp.read(LOCAL_HEADER_SIZE)
+            if len(header) < LOCAL_HEADER_SIZE or header[:4] != LOCAL_HEADER_SIGNATURE:
+                raise BadZipFile(f"Bad local file header at {offset}")
+            (_, extract_version, _, flag_bits, compress_type, dos_time, dos_date, crc, compress_size, file_size,
+             name_length, extra_length) = struct.unpack(LOCAL_HEADER_FORMAT, header)
+            if flag_bits & DATA_DESCRIPTOR_FLAG:
+                raise BadZipFile(f"Can not recover a member with a data descriptor at {offset}")
+            name = fp.read(name_length).decode("utf-8" if flag_bits & UTF8_FLAG else "cp437")
+            member = ZipInfo(name, (
+                (dos_date >> 9) + 1980, (dos_date >> 5) & 0xF, dos_date & 0x1F,
+                dos_time >> 11, (dos_time >> 5) & 0x3F, (dos_time & 0x1F) * 2,
+            ))
+            member.extract_version = extract_version
+            member.flag_bits = flag_bits
+            member.compress_type = compress_type
+            member.CRC = crc
+            member.compress_size = compress_size
+            member.file_size = file_size
+            member.header_offset = offset
+            members.append(member)
+            offset += LOCAL_HEADER_SIZE + name_length + extra_length + compress_size
+        if offset != end:
+            raise BadZipFile("The last member is not complete")
+
+        fp.seek(end)
+        archive = ZipFile(fp, 'w')
+        archive.filelist = members
+        archive.NameToInfo = {member.filename: member for member in members}
+        archive.start_dir = end
+        archive.close()
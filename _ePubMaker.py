@@ -15,6 +15,9 @@
     You should have received a copy of the GNU Affero General Public License
     along with this program.  If not, see [http://www.gnu.org/licenses/]
 """
+import copy
+import itertools
+import json
 import math
 import os
 import re
@@ -22,16 +25,45 @@ import sys
 import threading
 import traceback
 import uuid
+from collections import deque
+from contextlib import closing, contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor
 from datetime import datetime, timedelta
+from io import BytesIO
 from pathlib import Path
-from typing import Optional, List
-from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from typing import Optional, List, NamedTuple, Tuple
+from zipfile import ZipFile, ZIP_DEFLATED, BadZipFile
 
-import PIL.Image
-from jinja2 import Environment, FileSystemLoader, StrictUndefined
+from _Compression import CompressionPolicy, DEFAULT_LEVEL, format_size
+from _Crop import DEFAULT_MARGIN, DEFAULT_TOLERANCE, content_box, crop_box, crop_size, union
+from _Dedup import Deduplicator, perceptual_hash, perceptual_hash_of
+from _EInk import DEFAULT_GAMMA, eink_image, save_eink, numpy_available
+from _ImageIndex import ImageIndex, ImageInfo
+from _Plan import BookPlan, plan_page, reuse_page
+from _Prefetch import Prefetcher
+from _Profiler import Profiler, NullProfiler, StepTimer
+from _Profiles import OUTPUT_FORMATS, encode_to_budget
+from _Progress import ProgressTracker, JsonLinesProgress, format_rates
+from _Sources import open_source, is_source, DirectorySource
+from _Strips import even_cuts, is_strip, open_bands, page_ratio, strip_cuts, tile_height
+from _TranscodeCache import TranscodeCache, DEFAULT_CACHE_SIZE, hash_source
+from _ZipTools import is_stream, recover, write_stored
 
 MEDIA_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.gif': 'image/gif'}
 TEMPLATE_DIR = Path(__file__).parent.joinpath("templates")
+# the names of the filters in PIL.Image, which is only imported once images are transcoded to start quickly
+RESAMPLE_FILTERS = {
+    "nearest": "NEAREST", "box": "BOX", "bilinear": "BILINEAR", "hamming": "HAMMING", "bicubic": "BICUBIC",
+    "lanczos": "LANCZOS",
+}
+DEFAULT_RESAMPLE = "bicubic"
+DEFAULT_REDUCING_GAP = 3.0
+METADATA_FILE = "META-INF/images_to_epub.json"
+METADATA_VERSION = 1
+PAGE_FIELDS = ("id", "filename", "width", "height", "is_cover", "source")
+IMAGE_FIELDS = ("path", "size", "mtime", "type", "duplicate_of", "phash", "tile", "crop") + PAGE_FIELDS
+CHECKPOINT_SUFFIX = ".checkpoint"
+RESUME_SUFFIX = ".resume"
 
 
 def natural_keys(text):
@@ -50,19 +82,379 @@ def filter_images(files):
             yield x, file_type, extension
 
 
+class TransformSettings(NamedTuple):
+    max_width: Optional[int] = None
+    max_height: Optional[int] = None
+    grayscale: bool = False
+    resample: str = DEFAULT_RESAMPLE
+    reducing_gap: Optional[float] = DEFAULT_REDUCING_GAP
+    # the format of the pages with 16 levels of gray for e-ink screens, if any, and how the levels are found
+    eink: Optional[str] = None
+    gamma: float = DEFAULT_GAMMA
+    black_point: int = 0
+    white_point: int = 255
+    dither: bool = False
+    # the format all images are converted to, if any, and the number of bytes a page should fit in
+    output_format: Optional[str] = None
+    max_bytes: Optional[int] = None
+    # whether the margins of the images are cropped, and how their content is found
+    crop: bool = False
+    crop_tolerance: int = DEFAULT_TOLERANCE
+    crop_margin: float = DEFAULT_MARGIN
+    crop_spreads: bool = False
+
+
+class TranscodeResult(NamedTuple):
+    data: Optional[bytes]
+    width: int
+    height: int
+    type: str
+    # the perceptual hash of the image, only computed when asked for
+    phash: Optional[int] = None
+    # the steps measured while transcoding, and the process that transcoded the image
+    steps: tuple = ()
+    pid: Optional[int] = None
+
+
+def resized_size(settings: TransformSettings, width, height) -> Optional[Tuple[int, int]]:
+    """
+    :return: the size the image should be resized to, or None if it should not be resized
+    """
+    if (settings.max_width and settings.max_width < width) or (settings.max_height and settings.max_height < height):
+        width_scale = width / settings.max_width if settings.max_width else 1.0
+        height_scale = height / settings.max_height if settings.max_height else 1.0
+        scale = max(width_scale, height_scale)
+        return int(width / scale), int(height / scale)
+    return None
+
+
+def converts_format(settings: TransformSettings, file_type: str) -> bool:
+    return bool(settings.output_format) and OUTPUT_FORMATS[settings.output_format][1] != file_type
+
+
+def over_budget(settings: TransformSettings, size: int) -> bool:
+    return bool(settings.max_bytes) and settings.max_bytes < size
+
+
+def needs_transform(settings: TransformSettings, info: ImageInfo, box=None) -> bool:
+    return bool(
+        box or resized_size(settings, info.width, info.height) or (settings.grayscale and info.mode != "L")
+        or settings.eink or converts_format(settings, info.type) or over_budget(settings, info.size)
+    )
+
+
+def worker_pool(jobs: int) -> ProcessPoolExecutor:
+    """
+    :return: the pool of processes that decode the images when multiple jobs are used. The functions that are run on
+        it, like transcode_many, transcode_strip, strip_cuts, and content_box, are executed in another process, so
+        they should only use their arguments and return what can be pickled.
+    """
+    return ProcessPoolExecutor(max_workers=jobs)
+
+
+def transcode_image(source, settings: TransformSettings, perceptual=False, box=None) -> TranscodeResult:
+    """
+    Open an image and apply the transformations of the settings.
+
+    :param source: the path or the content of the image
+    :param perceptual: whether to compute the perceptual hash of the image as well
+    :param box: the left, top, right, and bottom of the part of the image that is kept, if it is cropped
+    :return: the result, of which the data is None if the source can be copied as-is
+    """
+    return transcode_many(source, [(settings, perceptual)], box)[0]
+
+
+def transcode_many(source, targets: List[Tuple[TransformSettings, bool]], box=None) -> List[TranscodeResult]:
+    """
+    Open and decode an image once, and apply the transformations of the settings of every target to it, like
+    transcode_image does for a single target. The image is cropped before anything else, so only the pixels that are
+    kept are resized and encoded.
+
+    :param targets: the settings, and whether to compute the perceptual hash, of every target
+    :return: the result of every target
+    """
+    import PIL.Image
+
+    timer = StepTimer()
+    with timer("open"):
+        image_data: PIL.Image.Image = PIL.Image.open(BytesIO(source) if isinstance(source, bytes) else source)
+    width, height = image_data.size
+    image_format = image_data.format
+    file_type = image_data.get_format_mimetype()
+    source_size = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+    kept_width, kept_height = crop_size(box) if box else (width, height)
+    plans = []
+    for settings, perceptual in targets:
+        new_size = resized_size(settings, kept_width, kept_height)
+        should_grayscale = settings.grayscale and image_data.mode != "L"
+        as_is = not box and not should_grayscale and not new_size and not settings.eink and \
+            not converts_format(settings, file_type) and not over_budget(settings, source_size)
+        plans.append((settings, perceptual, new_size, should_grayscale, as_is))
+
+    transformed = [plan for plan in plans if not plan[4]]
+    if transformed:
+        if image_format == "JPEG" and all(new_size for _, _, new_size, _, _ in transformed):
+            # let the JPEG decoder scale the image down by a power of two while decoding, which is a lot faster and
+            # uses less memory than decoding the full image, as long as the part that is kept stays large enough for
+            # every target
+            gray = all(should_grayscale or settings.eink for settings, _, _, should_grayscale, _ in transformed)
+            image_data.draft("L" if gray else image_data.mode, (
+                math.ceil(max(new_size[0] for _, _, new_size, _, _ in transformed) * width / kept_width),
+                math.ceil(max(new_size[1] for _, _, new_size, _, _ in transformed) * height / kept_height),
+            ))
+        with timer("decode"):
+            image_data.load()
+        if box:
+            # the image may have been scaled down while decoding
+            scale_x, scale_y = image_data.width / width, image_data.height / height
+            with timer("crop"):
+                image_data = image_data.crop((
+                    math.floor(box[0] * scale_x), math.floor(box[1] * scale_y),
+                    math.ceil(box[2] * scale_x), math.ceil(box[3] * scale_y),
+                ))
+
+    # resize to the largest sizes first, so the smaller sizes can be made from an image that is already smaller
+    order = sorted(range(len(plans)), key=lambda index: -area(plans[index][2] or (kept_width, kept_height)))
+    results: List[Optional[TranscodeResult]] = [None] * len(plans)
+    resized = [image_data]
+    for index in order:
+        settings, perceptual, new_size, should_grayscale, as_is = plans[index]
+        if as_is:
+            phash = None
+            if perceptual:
+                with timer("phash"):
+                    phash = perceptual_hash_of(source)
+            results[index] = TranscodeResult(None, width, height, file_type, phash, tuple(timer.steps), os.getpid())
+        else:
+            target = image_data
+            if new_size:
+                base = min((
+                    candidate for candidate in resized if new_size[0] <= candidate.width and
+                    new_size[1] <= candidate.height and (candidate.mode == image_data.mode or should_grayscale)
+                ), key=lambda candidate: area(candidate.size))
+                if should_grayscale and base.mode != "L":
+                    # resizing a single channel is cheaper
+                    with timer("grayscale"):
+                        base = base.convert("L")
+                with timer("resize"):
+                    target = base.resize(
+                        new_size, resample=getattr(PIL.Image, RESAMPLE_FILTERS[settings.resample]),
+                        reducing_gap=settings.reducing_gap,
+                    )
+                resized.append(target)
+            results[index] = transform_image(
+                target, settings, perceptual, should_grayscale, image_format, file_type, timer)
+        # the steps of opening and decoding the image are only counted for the first target
+        timer = StepTimer()
+    return results
+
+
+def transcode_strip(source, cuts: List[int], settings: TransformSettings, perceptual=False) -> List[TranscodeResult]:
+    """
+    Decode a strip in bands and transcode its pages, which are the rows between the cuts, like transcode_image does for
+    an image. Only a band and a page are in memory at a time.
+
+    :return: the result of every page
+    """
+    import PIL.Image
+
+    timer = StepTimer()
+    with timer("open"):
+        image_format, bands = open_bands(source, gray=settings.grayscale or bool(settings.eink))
+    file_type = PIL.Image.MIME[image_format]
+    results = []
+    tile = None
+    top = 0
+    while True:
+        with timer("decode"):
+            band = next(bands, None)
+        if band is None:
+            break
+        bottom = top + band.height
+        row = top
+        while row < bottom:
+            tile_top, tile_bottom = cuts[len(results)], cuts[len(results) + 1]
+            if tile is None:
+                tile = PIL.Image.new(band.mode, (band.width, tile_bottom - tile_top))
+                if band.mode == "P":
+                    tile.putpalette(band.getpalette())
+                tile.info.update(band.info)
+            end = min(bottom, tile_bottom)
+            tile.paste(band.crop((0, row - top, band.width, end - top)), (0, row - tile_top))
+            row = end
+            if row < tile_bottom:
+                continue
+            new_size = resized_size(settings, *tile.size)
+            should_grayscale = settings.grayscale and tile.mode != "L"
+            if new_size:
+                if should_grayscale:
+                    with timer("grayscale"):
+                        tile = tile.convert("L")
+                with timer("resize"):
+                    tile = tile.resize(
+                        new_size, resample=getattr(PIL.Image, RESAMPLE_FILTERS[settings.resample]),
+                        reducing_gap=settings.reducing_gap,
+                    )
+            results.append(transform_image(
+                tile, settings, perceptual, should_grayscale, image_format, file_type, timer))
+            tile = None
+            # the steps of opening the strip are only counted for the first page
+            timer = StepTimer()
+        top = bottom
+    return results
+
+
+def item_future(future: Future, index: int) -> Future:
+    """
+    :return: a future of the item at the index of the list that is the result of the future
+    """
+    item = Future()
+
+    def resolve(done: Future):
+        if not item.set_running_or_notify_cancel():
+            return
+        error = done.exception()
+        if error:
+            item.set_exception(error)
+        else:
+            item.set_result(done.result()[index])
+
+    future.add_done_callback(resolve)
+    return item
+
+
+def area(size: Tuple[int, int]) -> int:
+    return size[0] * size[1]
+
+
+def transform_image(image_data, settings: TransformSettings, perceptual, should_grayscale, image_format, file_type,
+                    timer: StepTimer) -> TranscodeResult:
+    """
+    Apply the transformations of the settings, other than resizing, to a decoded image and encode it. The image itself
+    is not changed.
+    """
+    if should_grayscale:
+        with timer("grayscale"):
+            image_data = image_data.convert("L")
+    if settings.eink:
+        with timer("eink"):
+            image_data = eink_image(
+                image_data, settings.eink, gamma=settings.gamma, black_point=settings.black_point,
+                white_point=settings.white_point, dither=settings.dither,
+            )
+        file_type = OUTPUT_FORMATS[settings.eink][1]
+    elif settings.output_format:
+        image_format, file_type, _ = OUTPUT_FORMATS[settings.output_format]
+    if not settings.eink and image_format == "JPEG" and image_data.mode not in ("L", "RGB", "CMYK"):
+        image_data = image_data.convert("RGB")
+    phash = None
+    if perceptual:
+        with timer("phash"):
+            phash = perceptual_hash(image_data)
+    output = BytesIO()
+    with timer("encode"):
+        if settings.eink:
+            save_eink(image_data, output, settings.eink)
+        elif settings.max_bytes:
+            output.write(encode_to_budget(image_data, image_format, settings.max_bytes)[0])
+        else:
+            image_data.save(output, format=image_format)
+    width, height = image_data.size
+    return TranscodeResult(output.getvalue(), width, height, file_type, phash, tuple(timer.steps), os.getpid())
+
+
+def volume_file(file, number: int) -> str:
+    """
+    :return: the file of a volume of the ePub file, when the book is split in volumes
+    """
+    stem, extension = os.path.splitext(file)
+    return f"{stem} - Volume {number}{extension}"
+
+
+def read_metadata(file) -> Optional[dict]:
+    """
+    :return: the metadata stored in an ePub made by this program, or None if it has no (supported) metadata
+    """
+    try:
+        with ZipFile(file) as archive:
+            metadata = json.loads(archive.read(METADATA_FILE))
+    except (IOError, KeyError, ValueError, BadZipFile):
+        return None
+    if metadata.get("version") != METADATA_VERSION:
+        return None
+    return metadata
+
+
+class PageRenderer:
+    """
+    Renders the page template for many images without going through Jinja for every page. The template is rendered
+    once for covers and once for other pages with markers instead of the values of the image, and pages are made by
+    replacing the markers. If that does not give the same result as Jinja, for example because the template changes
+    a value with a filter, every page is rendered by Jinja.
+    """
+    FIELDS = ("source", "width", "height", "filename")
+    MARKER = re.compile("\0([a-z_]+)\0")
+
+    def __init__(self, template):
+        self.template = template
+        self.parts = {}
+        self.verified = set()
+
+    def render(self, image) -> str:
+        is_cover = bool(image["is_cover"])
+        if is_cover not in self.parts:
+            try:
+                markers = {field: f"\0{field}\0" for field in self.FIELDS}
+                self.parts[is_cover] = self.MARKER.split(self.template.render(markers, is_cover=is_cover))
+            except Exception:
+                self.parts[is_cover] = None
+        parts = self.parts[is_cover]
+        if parts is None:
+            return self.template.render(image)
+
+        rendered = "".join(part if index % 2 == 0 else str(image[part]) for index, part in enumerate(parts))
+        if is_cover not in self.verified:
+            self.verified.add(is_cover)
+            if rendered != self.template.render(image):
+                self.parts[is_cover] = None
+                return self.template.render(image)
+        return rendered
+
+
+def completed_future(value) -> Future:
+    future = Future()
+    future.set_result(value)
+    return future
+
+
 class Chapter:
-    def __init__(self, dir_path, title, start: str = None):
+    """
+    A chapter and its sub chapters. The start and depth are computed once and cached, so the tree should be complete
+    before they are used.
+    """
+
+    def __init__(self, dir_path, title, start: str = None, images=None):
         self.dir_path = dir_path
         self.title = title
         self.children: List[Chapter] = []
+        # the images of the chapter itself, not of its sub chapters
+        self.images = images or []
         self._start = start
+        self._first_start = None
+        self._depth = None
+
+    def add_child(self, chapter: "Chapter"):
+        self.children.append(chapter)
+        self._first_start = None
+        self._depth = None
 
     @property
     def start(self) -> Optional[str]:
         if self._start:
             return self._start
-        if self.children:
-            return self.children[0].start
+        if self._first_start is None and self.children:
+            self._first_start = self.children[0].start
+        return self._first_start
 
     @start.setter
     def start(self, value):
@@ -70,13 +462,49 @@ class Chapter:
 
     @property
     def depth(self) -> int:
-        if self.children:
-            return 1 + max(child.depth for child in self.children)
-        return 1
+        if self._depth is None:
+            self._depth = 1 + max((child.depth for child in self.children), default=0)
+        return self._depth
+
+
+def volume_tree(chapter: Chapter, ids) -> Optional[Chapter]:
+    """
+    :return: a copy of the chapter with only the images that have one of the ids, or None if it has none of them
+    """
+    images = [image for image in chapter.images if image["id"] in ids]
+    result = Chapter(chapter.dir_path, chapter.title, images[0] if images else None, images)
+    for child in chapter.children:
+        child = volume_tree(child, ids)
+        if child:
+            result.add_child(child)
+    return result if images or result.children else None
+
+
+class Volume:
+    """
+    One of the ePubs that are made of the images. A book is a single volume, unless it is split.
+    """
+
+    def __init__(self, number, file, name, volume_uuid, images=None):
+        self.number = number
+        self.file = file
+        self.name = name
+        self.uuid = volume_uuid
+        self.images = [] if images is None else images
+        self.ids = set()
+        self.cover = None
+        self.chapter_tree: Optional[Chapter] = None
 
 
 class EPubMaker(threading.Thread):
-    def __init__(self, master, input_dir, file, name, wrap_pages, grayscale, max_width, max_height, progress=None):
+    def __init__(self, master, input_dir, file, name, wrap_pages, grayscale, max_width, max_height, progress=None,
+                 resample=DEFAULT_RESAMPLE, reducing_gap=DEFAULT_REDUCING_GAP, jobs=1, cache_dir=None,
+                 cache_size=DEFAULT_CACHE_SIZE, update=None, index_file=None, compression_level=DEFAULT_LEVEL,
+                 compression_sample=False, fingerprint=None, profile=None, dedup=False, dedup_threshold=None,
+                 prefetch=0, progress_json=None, split_size=None, split_pages=None, checkpoint=False, eink=None,
+                 gamma=DEFAULT_GAMMA, black_point=0, white_point=255, dither=False, output_format=None, page_bytes=None,
+                 book_bytes=None, strips=False, crop=False, crop_tolerance=DEFAULT_TOLERANCE,
+                 crop_margin=DEFAULT_MARGIN, crop_spreads=False):
         threading.Thread.__init__(self)
         self.master = master
         self.progress = None
@@ -85,12 +513,21 @@ class EPubMaker(threading.Thread):
         elif progress:
             self.progress = progress
         self.dir = input_dir
+        self.source: Optional[DirectorySource] = None
         self.file = file
+        # the ePub is written to a file object instead of a path, like a pipe or a buffer in memory, which does not
+        # have to be seekable
+        self.stream = is_stream(file)
+        self.update = update
+        # an ePub that is updated in place is only replaced when the new one is complete
+        self.output_file = file
+        if update and not self.stream and os.path.isfile(file) and os.path.samefile(update, file):
+            self.output_file = str(file) + ".part"
         self.name = name
         self.picture_at = 1
         self.stop_event = False
 
-        self.template_env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), undefined=StrictUndefined)
+        self.template_env = None
 
         self.zip: Optional[ZipFile] = None
         self.cover = None
@@ -100,22 +537,120 @@ class EPubMaker(threading.Thread):
         self.grayscale = grayscale
         self.max_width = max_width
         self.max_height = max_height
+        self.resample = resample
+        self.reducing_gap = reducing_gap
         self.wrap_pages = wrap_pages
+        self.eink = eink
+        self.gamma = gamma
+        self.black_point = black_point
+        self.white_point = white_point
+        self.dither = dither
+        self.output_format = output_format
+        # the budgets in bytes of every page and of the whole book, and the budget of a page that follows from them
+        self.page_bytes = page_bytes
+        self.book_bytes = book_bytes
+        self.max_bytes = page_bytes
+        self.over_budget = 0
+        # whether images many pages tall are cut in pages, and the number of strips and pages they were cut in
+        self.strips = strips
+        self.strips_cut = 0
+        self.strip_pages = 0
+        self.crop = crop
+        self.crop_tolerance = crop_tolerance
+        self.crop_margin = crop_margin
+        self.crop_spreads = crop_spreads
+        # the number of pages that were cropped, and the pixels of the pages and of their margins that were cropped
+        self.pages_cropped = 0
+        self.pixels = 0
+        self.pixels_cropped = 0
+        # the number of pages of which the content is not known, as it is not in the index of a dry run
+        self.crops_unknown = 0
+        # the chapters and images found by another EPubMaker, and the transcoder it shares with this one, if any
+        self.shared_tree = None
+        self.shared = None
+        self.shared_position = 0
+        self.jobs = jobs if jobs and 0 < jobs else os.cpu_count() or 1
+        self.cache = TranscodeCache(cache_dir, cache_size) if cache_dir else None
+        self.index = ImageIndex(index_file)
+        self.compression = CompressionPolicy(compression_level, compression_sample)
+        self.fingerprint = fingerprint
+        self.profiler = Profiler(profile) if profile else NullProfiler()
+        self.dedup = Deduplicator(dedup_threshold) if dedup or dedup_threshold is not None else None
+        self.images_by_id = {}
+        # the number of bytes of images that are read ahead, if any
+        self.prefetch = prefetch
+        self.prefetcher: Optional[Prefetcher] = None
+        self.tracker = ProgressTracker(
+            self.progress, JsonLinesProgress(progress_json) if progress_json else None, book=name)
+        # the maximum size in bytes and number of pages of a volume, if the book is split
+        self.split_size = split_size
+        self.split_pages = split_pages
+        self.split = bool(split_size or split_pages)
+        self.volumes: List[Volume] = []
+        self.volume: Optional[Volume] = None
+        # the number of pages and the size of the images of every directory, by the id of its first image
+        self.units = {}
+        self.error: Optional[Exception] = None
+        self.previous: Optional[ZipFile] = None
+        self.previous_metadata = {}
+        # the journal of the pages that are written, so an interrupted run can be continued
+        self.checkpoint = None
+        self.resume_file = None
+        if checkpoint and not update and not self.split and not self.stream:
+            self.checkpoint = str(self.output_file) + CHECKPOINT_SUFFIX
+            self.resume_file = str(self.output_file) + RESUME_SUFFIX
+        self.checkpoint_journal = None
+
+    @property
+    def transform_settings(self) -> TransformSettings:
+        return TransformSettings(
+            max_width=self.max_width, max_height=self.max_height, grayscale=self.grayscale, resample=self.resample,
+            reducing_gap=self.reducing_gap, eink=self.eink, gamma=self.gamma, black_point=self.black_point,
+            white_point=self.white_point, dither=self.dither, output_format=self.output_format,
+            max_bytes=self.max_bytes, crop=self.crop, crop_tolerance=self.crop_tolerance, crop_margin=self.crop_margin,
+            crop_spreads=self.crop_spreads,
+        )
 
     def run(self):
         try:
-            assert os.path.isdir(self.dir), "The given directory does not exist!"
+            assert is_source(self.dir), "The given directory or archive does not exist!"
             assert self.name, "No name given!"
+            assert not self.update or os.path.isfile(self.update), "The ePub to update does not exist!"
+            assert self.wrap_pages or not self.dedup, "Duplicate pages can only be removed when the pages are wrapped!"
+            assert not self.update or not self.split, "An ePub can not be updated when it is split in volumes!"
+            assert not self.stream or not self.split, "An ePub that is streamed can not be split in volumes!"
+            assert not self.eink or numpy_available(), "E-ink pages need NumPy, install it with pip install numpy!"
+            assert not self.strips or not self.shared, "Strips can not be cut when ePubs are made in a single pass!"
+            assert not self.crop or numpy_available(), "Cropping needs NumPy, install it with pip install numpy!"
 
             self.make_epub()
+            self.tracker.done()
 
             if self.master is None:
                 print()
-                print("ePub created")
+                print("ePub created" if len(self.volumes) < 2 else f"ePub created in {len(self.volumes)} volumes")
+                print(self.compression.summary())
+                if self.cache:
+                    print(self.cache.summary())
+                if self.dedup:
+                    print(self.dedup.summary())
+                if self.prefetcher:
+                    print(self.prefetcher.summary())
+                if self.strips_cut:
+                    print(f"Strips: {self.strips_cut} strips cut in {self.strip_pages} pages")
+                if self.crop:
+                    print(self.crop_summary())
+                if self.max_bytes:
+                    print(
+                        f"Budget: {self.over_budget} of {len(self.images)} pages over {format_size(self.max_bytes)}, "
+                        f"{format_size(self.tracker.bytes_written)} of images"
+                        + (f" for a budget of {format_size(self.book_bytes)}" if self.book_bytes else "")
+                    )
             else:
                 self.master.generic_queue.put(lambda: self.master.stop(1))
 
         except Exception as e:
+            self.error = e
             if not isinstance(e, StopException):
                 if self.master is not None:
                     self.master.generic_queue.put(lambda: self.master.showerror(
@@ -125,38 +660,221 @@ class EPubMaker(threading.Thread):
                 else:
                     print("Error encountered:", file=sys.stderr)
                     traceback.print_exc()
-            try:
-                if os.path.isfile(self.file):
-                    os.remove(self.file)
-            except IOError:
-                pass
+            if self.checkpoint and os.path.isfile(self.checkpoint) and os.path.isfile(self.output_file):
+                if self.master is None:
+                    print("The finished pages are kept, run again with the same settings to continue", file=sys.stderr)
+                return
+            if self.stream:
+                # what was written to the stream can not be taken back, so the reader has to drop the partial ePub
+                return
+            for file in {self.output_file}.union(volume.file for volume in self.volumes):
+                try:
+                    if os.path.isfile(file):
+                        os.remove(file)
+                except IOError:
+                    pass
+        finally:
+            if self.shared:
+                self.shared.leave(self.shared_position)
+            self.profiler.save()
+            self.index.save()
+            if self.cache:
+                self.cache.save()
 
     def make_epub(self):
-        with ZipFile(self.file, mode='w', compression=ZIP_DEFLATED) as self.zip:
-            self.zip.writestr('mimetype', 'application/epub+zip', compress_type=ZIP_STORED)
-            self.add_file('META-INF', "container.xml")
-            self.add_file('stylesheet.css')
+        if self.update:
+            self.load_previous_metadata()
+            with ZipFile(self.update) as self.previous:
+                self.write_epub()
+        elif self.checkpoint and self.load_checkpoint():
+            with ZipFile(self.resume_file) as self.previous:
+                self.write_epub()
+        else:
+            self.write_epub()
+        if self.output_file != self.file:
+            os.replace(self.output_file, self.file)
+        if self.split:
+            # the volumes of an earlier run of a larger book would be taken for volumes of this one
+            number = len(self.volumes) + 1
+            while os.path.isfile(volume_file(self.output_file, number)):
+                os.remove(volume_file(self.output_file, number))
+                number += 1
+        if self.checkpoint:
+            for file in (self.checkpoint, self.resume_file):
+                if os.path.isfile(file):
+                    os.remove(file)
+
+    def plan(self) -> BookPlan:
+        """
+        Find what making the ePub would do from the chapters and the headers of the images, without decoding them.
+        """
+        if self.update:
+            self.load_previous_metadata()
+        with open_source(self.dir) as self.source:
             self.make_tree()
+            if self.strips:
+                self.cut_strips(estimate=True)
+            if self.crop:
+                self.find_crops(estimate=True)
             self.assign_image_ids()
-            self.write_images()
+            self.match_previous_images()
+            self.scan_images()
+        self.index.save()
+        reused = {}
+        if self.update and any("previous" in image for image in self.images):
+            with ZipFile(self.update) as archive:
+                reused = {info.filename: info.compress_size for info in archive.infolist()}
+        settings = self.transform_settings
+        pages = []
+        for image in self.images:
+            previous = image.get("previous")
+            if previous:
+                pages.append(reuse_page(image, reused.get(os.path.join('images', previous["filename"]), 0)))
+            else:
+                info = image["info"]
+                kept_size = crop_size(image["crop"]) if image["crop"] else (info.width, info.height)
+                pages.append(plan_page(
+                    info, bool(image["tile"]) or needs_transform(settings, info, image["crop"]),
+                    resized_size(settings, *kept_size),
+                    (settings.grayscale or bool(settings.eink)) and info.mode != "L", bool(settings.eink),
+                    settings.max_bytes,
+                ))
+        return BookPlan(
+            self.name, self.file, self.chapter_tree, pages, self.jobs, self.crop_summary() if self.crop else None)
+
+    def write_epub(self):
+        with open_source(self.dir) as self.source:
+            with self.phase("make_tree"):
+                if self.shared_tree:
+                    self.chapter_tree, self.images, self.cover = copy.deepcopy(self.shared_tree)
+                else:
+                    self.make_tree()
+            if self.strips:
+                with self.phase("cut_strips"):
+                    self.cut_strips()
+            if self.crop:
+                with self.phase("find_crops"):
+                    self.find_crops()
+            with self.phase("scan"):
+                self.assign_image_ids()
+                self.match_previous_images()
+                self.find_units()
+                self.scan_images()
+            try:
+                self.open_volume()
+                with self.phase("write_images"):
+                    self.write_images()
+                self.close_volume()
+            finally:
+                if self.zip:
+                    self.zip.close()
+                    self.zip = None
+
+    def open_volume(self):
+        number = len(self.volumes) + 1
+        if self.split:
+            volume = Volume(
+                number, volume_file(self.output_file, number), f"{self.name} - Volume {number}",
+                'urn:uuid:' + str(uuid.uuid5(uuid.UUID(self.uuid[len('urn:uuid:'):]), f"volume {number}")),
+            )
+            if self.dedup:
+                # a page can only be replaced by a page of the same volume
+                self.dedup.reset()
+        else:
+            volume = Volume(number, self.output_file, self.name, self.uuid, self.images)
+        self.volumes.append(volume)
+        self.volume = volume
+        self.zip = ZipFile(
+            volume.file, mode='w', compression=ZIP_DEFLATED, compresslevel=self.compression.level)
+        # the mimetype is written with its size in its header even when the other members of a stream get a data
+        # descriptor, as readers find the type of the ePub at a fixed offset of the file
+        write_stored(self.zip, 'mimetype', b'application/epub+zip')
+        self.add_file('META-INF', "container.xml")
+        self.add_file('stylesheet.css')
+
+    def close_volume(self):
+        volume = self.volume
+        volume.cover = next((image for image in volume.images if image["is_cover"]), None)
+        volume.chapter_tree = self.chapter_tree
+        if self.split:
+            volume.chapter_tree = volume_tree(self.chapter_tree, volume.ids)
+            while len(volume.chapter_tree.children) == 1:
+                volume.chapter_tree = volume.chapter_tree.children[0]
+        with self.phase("write_templates"):
             self.write_template('package.opf')
             self.write_template('toc.xhtml')
             self.write_template('toc.ncx')
+            self.write_metadata()
+        self.zip.close()
+        self.zip = None
+
+    def find_units(self):
+        """
+        Find where a volume can start without splitting a chapter, which is at the first image of a directory.
+        """
+        for _, images in itertools.groupby(self.images, key=lambda image: os.path.dirname(image["source"])):
+            images = list(images)
+            self.units[images[0]["id"]] = (len(images), sum(image["size"] for image in images))
+
+    def should_split(self, image) -> bool:
+        """
+        :return: whether the image should be the first of a new volume, which is the case when the current volume is
+            full, or when the directory that starts with the image is not expected to fit in the current volume
+        """
+        pages = len(self.volume.images)
+        size = self.zip.start_dir
+        if (self.split_pages and self.split_pages <= pages) or (self.split_size and self.split_size <= size):
+            return True
+        if image["id"] not in self.units:
+            return False
+        unit_pages, unit_size = self.units[image["id"]]
+        # the size of the images in the ePub is estimated with how much the images shrunk so far
+        ratio = self.tracker.bytes_written / self.tracker.bytes_read if self.tracker.bytes_read else 1.0
+        return bool(
+            (self.split_pages and self.split_pages < pages + unit_pages) or
+            (self.split_size and self.split_size < size + unit_size * ratio)
+        )
+
+    def add_to_volume(self, image):
+        if self.volume.images and self.should_split(image):
+            self.close_volume()
+            self.open_volume()
+        if self.split:
+            # the first page of every volume is its cover, as the cover of the book may be in another volume
+            image["is_cover"] = not self.volume.images
+        self.volume.images.append(image)
+        self.volume.ids.add(image["id"])
+
+    @contextmanager
+    def phase(self, name):
+        self.tracker.phase(name)
+        with self.profiler.phase(name):
+            yield
 
     def add_file(self, *path: str):
-        self.zip.write(TEMPLATE_DIR.joinpath(*path), os.path.join(*path))
+        self.compression.write(self.zip, os.path.join(*path), source=TEMPLATE_DIR.joinpath(*path))
+
+    def share(self, chapter_tree, images, cover, index: ImageIndex, transcoder, position):
+        """
+        Make the ePub of the chapters and images found by another EPubMaker for the same directory, and let the
+        transcoder, at the given position, decode every image once for all of them.
+        """
+        self.shared_tree = (chapter_tree, images, cover)
+        self.index = index
+        self.shared = transcoder
+        self.shared_position = position
 
     def make_tree(self):
         root = Path(self.dir)
         self.chapter_tree = Chapter(root.parent, None)
         chapter_shortcuts = {root.parent: self.chapter_tree}
 
-        for dir_path, dir_names, filenames in os.walk(self.dir):
+        for dir_path, dir_names, filenames in self.source.walk():
             dir_names.sort(key=natural_keys)
             images = self.get_images(filenames, dir_path)
             dir_path = Path(dir_path)
-            chapter = Chapter(dir_path, dir_path.name, images[0] if images else None)
-            chapter_shortcuts[dir_path.parent].children.append(chapter)
+            chapter = Chapter(dir_path, dir_path.name, images[0] if images else None, images)
+            chapter_shortcuts[dir_path.parent].add_child(chapter)
             chapter_shortcuts[dir_path] = chapter
 
         while len(self.chapter_tree.children) == 1:
@@ -173,10 +891,164 @@ class EPubMaker(threading.Thread):
         return result
 
     def add_image(self, source, file_type, extension):
-        data = {"extension": extension, "type": file_type, "source": source, "is_cover": False}
+        size, mtime = self.source.stat(source)
+        data = {
+            "extension": extension, "type": file_type, "source": source, "is_cover": False,
+            "path": os.path.relpath(source, self.dir), "size": size, "mtime": mtime, "duplicate_of": None,
+            "phash": None, "tile": None, "crop": None,
+        }
         self.images.append(data)
         return data
 
+    def cut_strips(self, estimate=False):
+        """
+        Cut every strip, an image that is many pages tall like a chapter of a webtoon, in pages at the rows without
+        content, and put the pages in the chapter of the strip. The strips are decoded in bands on multiple processes,
+        and the rows they are cut at are kept in the index.
+
+        :param estimate: whether to cut the strips of which the cuts are not in the index in pages of the same height,
+            without decoding them
+        """
+        infos = self.scan_headers()
+        ratio = page_ratio(self.max_width, self.max_height)
+        strips = [
+            (image, tile_height(infos[image["source"]].width, ratio)) for image in self.images
+            if is_strip(infos[image["source"]], ratio)
+        ]
+        cuts = self.analyse_images("cuts", strip_cuts, strips, infos, estimate and (
+            lambda image, height: even_cuts(infos[image["source"]].height, height)))
+        strips = [image for image, _ in strips]
+        tiles = {id(image): self.make_tiles(image, infos[image["source"]], cuts[id(image)]) for image in strips}
+        if not tiles:
+            return
+
+        def replace(chapter: Chapter):
+            chapter.images = [tile for image in chapter.images for tile in tiles.get(id(image), [image])]
+            if chapter.images:
+                chapter.start = chapter.images[0]
+            for child in chapter.children:
+                replace(child)
+
+        replace(self.chapter_tree)
+        self.images = [tile for image in self.images for tile in tiles.get(id(image), [image])]
+        if self.cover and id(self.cover) in tiles:
+            self.cover = tiles[id(self.cover)][0]
+        self.strips_cut = len(tiles)
+        self.strip_pages = sum(len(pages) for pages in tiles.values())
+
+    def scan_headers(self) -> dict:
+        """
+        :return: the information of the headers of all images by source, which is read before the pages are known
+        """
+        return self.index.scan(
+            ((image["source"], image["size"], image["mtime"]) for image in self.images if not image["tile"]),
+            self.source.open)
+
+    def analyse_images(self, kind: str, function, images: list, infos: dict, estimate=None) -> dict:
+        """
+        Analyse images by decoding them on multiple processes, like finding the rows at which strips are cut. The
+        results are kept in the index, so only the images that changed are decoded again.
+
+        :param function: called with what is given to a worker process to open an image and its parameters
+        :param images: every image with the parameters of its analysis
+        :param estimate: if given, it is called with an image and its parameters instead of decoding the image, when
+            its result is not in the index
+        :return: the result of every image by the id of its dict
+        """
+        results = {}
+        missing = []
+        for image, parameters in images:
+            info = infos[image["source"]]
+            found, results[id(image)] = self.index.get_analysis(kind, image["source"], info, parameters)
+            if not found and estimate:
+                results[id(image)] = estimate(image, parameters)
+            elif not found:
+                missing.append((image, parameters))
+
+        executor = worker_pool(self.jobs) if 1 < self.jobs and 1 < len(missing) else None
+        pending = deque()
+
+        def finish():
+            image, parameters, future = pending.popleft()
+            results[id(image)] = future.result()
+            self.index.set_analysis(kind, image["source"], infos[image["source"]], parameters, results[id(image)])
+
+        try:
+            for image, parameters in missing:
+                # archives give the content of an image, so only a few images are read ahead
+                if self.jobs * 2 <= len(pending):
+                    finish()
+                source = self.source.transcode_input(image["source"])
+                pending.append((image, parameters, executor.submit(function, source, parameters) if executor else
+                                completed_future(function(source, parameters))))
+                self.check_is_stopped()
+            while pending:
+                finish()
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            if executor:
+                executor.shutdown(wait=True)
+        return results
+
+    def find_crops(self, estimate=False):
+        """
+        Find the part of every image that is kept when its margins are cropped. The content of the images is found on
+        multiple processes and kept in the index. Facing pages, the pages after the cover two at a time, are cropped
+        the same if they have the same size, so the pages of a spread still line up.
+
+        :param estimate: whether to not crop the images of which the content is not in the index, instead of decoding
+            them
+        """
+        infos = self.scan_headers()
+        # the pages of strips are not cropped, as the pages of a strip should keep the same width
+        images = [image for image in self.images if not image["tile"]]
+        self.pages_cropped = self.pixels = self.pixels_cropped = 0
+        self.crops_unknown = 0
+
+        def unknown_content(*_):
+            self.crops_unknown += 1
+            return None
+
+        contents = self.analyse_images(
+            "content", content_box, [(image, self.crop_tolerance) for image in images], infos,
+            estimate and unknown_content)
+        if self.crop_spreads:
+            for left, right in zip(images[1::2], images[2::2]):
+                left_info, right_info = infos[left["source"]], infos[right["source"]]
+                if (left_info.width, left_info.height) == (right_info.width, right_info.height):
+                    contents[id(left)] = contents[id(right)] = union(contents[id(left)], contents[id(right)])
+        for image in images:
+            info = infos[image["source"]]
+            image["crop"] = crop_box(contents[id(image)], (info.width, info.height), self.crop_margin)
+            self.pixels += info.width * info.height
+            if image["crop"]:
+                self.pages_cropped += 1
+                self.pixels_cropped += info.width * info.height - area(crop_size(image["crop"]))
+
+    def crop_summary(self) -> str:
+        return (
+            f"Crop: {self.pages_cropped} pages cropped, "
+            f"{self.pixels_cropped / max(1, self.pixels):.1%} of the pixels were margins"
+            + (f", {self.crops_unknown} pages not in the index" if self.crops_unknown else "")
+        )
+
+    @staticmethod
+    def make_tiles(image, info: ImageInfo, cuts: List[int]) -> list:
+        """
+        :return: the pages of a strip, of which the path tells the rows they have and the size is their part of the
+            size of the strip
+        """
+        tiles = []
+        for top, bottom in zip(cuts, cuts[1:]):
+            size = image["size"] * bottom // info.height - image["size"] * top // info.height
+            tiles.append(dict(
+                image, path=f"{image['path']}#{top}-{bottom}", size=size, tile=[top, bottom], cuts=cuts,
+                is_cover=image["is_cover"] and top == 0,
+                info=ImageInfo(info.width, bottom - top, info.type, info.mode, size, info.mtime),
+            ))
+        return tiles
+
     def assign_image_ids(self):
         if not self.cover and self.images:
             cover = self.images[0]
@@ -184,55 +1056,347 @@ class EPubMaker(threading.Thread):
             self.cover = cover
         padding_width = len(str(len(self.images)))
         for count, image in enumerate(self.images):
+            if self.eink or self.output_format:
+                # every image is converted to the same format
+                image["extension"] = OUTPUT_FORMATS[self.eink or self.output_format][2]
             image["id"] = f"image_{count:0{padding_width}}"
             image["filename"] = image["id"] + image["extension"]
+            self.images_by_id[image["id"]] = image
+        if self.book_bytes and self.images:
+            # every page gets at least a byte, so a budget smaller than the number of pages is not taken as no budget
+            share = max(1, self.book_bytes // len(self.images))
+            self.max_bytes = min(self.page_bytes, share) if self.page_bytes else share
+
+    def load_previous_metadata(self):
+        """
+        Read the metadata that was stored in the ePub that is updated. Nothing is reused if the ePub was not made by
+        this program.
+        """
+        metadata = read_metadata(self.update)
+        if not metadata:
+            return
+        self.uuid = metadata["uuid"]
+        self.previous_metadata = metadata
+
+    def load_checkpoint(self) -> bool:
+        """
+        Continue an interrupted run. The output file of that run is moved aside and cut off after the last page in the
+        checkpoint, so its pages can be copied like those of an ePub that is updated.
+        :return: whether there is a run to continue
+        """
+        try:
+            with open(self.checkpoint, encoding="utf-8") as file:
+                # the last line may not be complete
+                lines = [json.loads(line) for line in file if line.endswith("\n")]
+        except (IOError, ValueError):
+            return False
+        if len(lines) < 2 or not os.path.isfile(self.output_file):
+            return False
+        header, pages = lines[0], lines[1:]
+        if header.get("version") != METADATA_VERSION:
+            return False
+        os.replace(self.output_file, self.resume_file)
+        try:
+            recover(self.resume_file, pages[-1]["end"])
+        except (IOError, BadZipFile):
+            return False
+        self.uuid = header["uuid"]
+        self.previous_metadata = {"settings": header["settings"], "wrap_pages": header["wrap_pages"], "images": pages}
+        return True
+
+    def write_checkpoint(self, entry: dict):
+        self.checkpoint_journal.write(json.dumps(entry) + "\n")
+        self.checkpoint_journal.flush()
+
+    def match_previous_images(self):
+        """
+        Mark the images of which the source did not change since the ePub that is updated was made, so the image and
+        its page can be copied from that ePub. Duplicate pages are not reused, as they have no image of their own, and
+        nothing is reused if the ePub was made with different settings. The settings are only compared now, as the
+        budget of a page depends on the number of pages.
+        """
+        if self.previous_metadata.get("settings") != list(self.transform_settings):
+            return
+        previous_images = {image["path"]: image for image in self.previous_metadata.get("images", [])}
+        for image in self.images:
+            previous = previous_images.get(image["path"])
+            if previous and previous["size"] == image["size"] and previous["mtime"] == image["mtime"] and \
+                    not previous.get("duplicate_of") and previous.get("crop") == image["crop"]:
+                image["previous"] = previous
+                image["width"], image["height"], image["type"] = previous["width"], previous["height"], previous["type"]
+
+    def scan_images(self):
+        """
+        Read the headers of the images, so the size and type of every page is known before any image is decoded.
+        """
+        images = [image for image in self.images if "previous" not in image]
+        # the pages of strips have the information of their rows
+        infos = self.index.scan(
+            ((image["source"], image["size"], image["mtime"]) for image in images if not image["tile"]),
+            self.source.open)
+        settings = self.transform_settings
+        for image in images:
+            info = image["info"] = image.get("info") or infos[image["source"]]
+            kept_size = crop_size(image["crop"]) if image["crop"] else (info.width, info.height)
+            image["width"], image["height"] = resized_size(settings, *kept_size) or kept_size
+            image["type"] = info.type
+        self.check_is_stopped()
+
+    def write_metadata(self):
+        """
+        Store how the ePub was made, so it can be updated later on.
+        """
+        self.compression.write_stream(self.zip, METADATA_FILE, json.JSONEncoder().iterencode({
+            "version": METADATA_VERSION, "uuid": self.volume.uuid, "settings": list(self.transform_settings),
+            "wrap_pages": self.wrap_pages, "fingerprint": self.fingerprint,
+            "volume": self.volume.number if self.split else None, "images": [
+                {key: image[key] for key in IMAGE_FIELDS} for image in self.volume.images
+            ],
+        }))
 
     def write_images(self):
-        if self.progress:
-            self.progress.progress_set_maximum(len(self.images))
-            self.progress.progress_set_value(0)
-
-        template = self.template_env.get_template("page.xhtml.jinja2")
-
-        for progress, image in enumerate(self.images):
-            output = os.path.join('images', image["filename"])
-            image_data: PIL.Image.Image = PIL.Image.open(image["source"])
-            image["width"], image["height"] = image_data.size
-            image["type"] = image_data.get_format_mimetype()
-            should_resize = (self.max_width and self.max_width < image["width"]) or (
-                        self.max_height and self.max_height < image["height"])
-            should_grayscale = self.grayscale and image_data.mode != "L"
-            if not should_grayscale and not should_resize:
-                self.zip.write(image["source"], output)
+        self.tracker.start(len(self.images), sum(image["size"] for image in self.images))
+
+        template = PageRenderer(self.get_template("page.xhtml.jinja2"))
+
+        if self.prefetch:
+            self.prefetcher = Prefetcher(self.source.read, self.prefetch)
+            self.prefetcher.start((image["source"], image["size"]) for image in self.images if "previous" not in image)
+        if self.checkpoint:
+            self.checkpoint_journal = open(self.checkpoint, 'w', encoding="utf-8")
+            self.write_checkpoint({
+                "version": METADATA_VERSION, "uuid": self.uuid, "settings": list(self.transform_settings),
+                "wrap_pages": self.wrap_pages,
+            })
+        try:
+            with closing(self.transcode_images()) as results:
+                for image, result in results:
+                    if self.split:
+                        self.add_to_volume(image)
+                    self.write_image(template, image, result)
+                    if self.checkpoint_journal:
+                        # the page is only in the checkpoint once it is on disk
+                        self.zip.fp.flush()
+                        self.write_checkpoint(dict({key: image[key] for key in IMAGE_FIELDS}, end=self.zip.start_dir))
+                    if self.prefetcher:
+                        self.prefetcher.release(image["source"])
+                    self.check_is_stopped()
+        finally:
+            if self.prefetcher:
+                self.prefetcher.close()
+            if self.checkpoint_journal:
+                self.checkpoint_journal.close()
+                self.checkpoint_journal = None
+
+    def find_duplicate(self, image, result: TranscodeResult):
+        """
+        Mark an image as a duplicate if a similar image was written before, in which case its page shows that image.
+        """
+        if image["phash"] is None:
+            return
+        original_id = self.dedup.find_similar(image["phash"], image["id"])
+        if original_id and not image["is_cover"]:
+            image["duplicate_of"] = original_id
+
+    def write_image(self, template: PageRenderer, image, result: TranscodeResult):
+        if image["duplicate_of"] and self.split and image["duplicate_of"] not in self.volume.ids:
+            # the original is in an earlier volume, so this image becomes the original in this volume
+            image["duplicate_of"] = None
+            self.dedup.set_original(image["content_hash"], image["id"])
+            result = self.transcode_now(image)
+        image["width"], image["height"], image["type"] = result.width, result.height, result.type
+        image["phash"] = result.phash
+        if self.dedup and self.dedup.perceptual and not image["duplicate_of"]:
+            self.find_duplicate(image, result)
+        if image["duplicate_of"]:
+            original = self.images_by_id[image["duplicate_of"]]
+            for key in ("filename", "width", "height", "type"):
+                image[key] = original[key]
+        output = os.path.join('images', image["filename"])
+        timer = StepTimer()
+        with timer("write_image"):
+            previous = image.get("previous")
+            if image["duplicate_of"]:
+                self.dedup.add_duplicate(self.zip.getinfo(output).compress_size)
+            elif previous:
+                self.compression.copy(self.previous, os.path.join('images', previous["filename"]), self.zip, output)
+            elif result.data is None and self.prefetcher:
+                # the image is already read, so it is written from memory rather than copied from an archive as it
+                # is stored, which would read it again from the slow storage that prefetching is for
+                self.compression.write(
+                    self.zip, output, self.prefetcher.read(image["source"]), file_type=result.type)
+            elif result.data is None:
+                self.source.write(image["source"], self.zip, output, self.compression, result.type)
             else:
-                image_format = image_data.format
-                if should_resize:
-                    width_scale = image["width"] / self.max_width if self.max_width else 1.0
-                    height_scale = image["height"] / self.max_height if self.max_height else 1.0
-                    scale = max(width_scale, height_scale)
-                    image_data = image_data.resize((int(image["width"] / scale), int(image["height"] / scale)))
-                    image["width"], image["height"] = image_data.size
-                if should_grayscale:
-                    image_data = image_data.convert("L")
-                with self.zip.open(output, "w") as image_file:
-                    image_data.save(image_file, format=image_format)
+                self.compression.write(self.zip, output, result.data, file_type=result.type)
+
+        if self.wrap_pages:
+            page = os.path.join("pages", image["id"] + ".xhtml")
+            if previous and self.previous_metadata["wrap_pages"] and all(
+                    previous[key] == image[key] for key in PAGE_FIELDS):
+                self.compression.copy(self.previous, page, self.zip)
+            else:
+                with timer("render_page"):
+                    rendered = template.render(image)
+                with timer("write_page"):
+                    self.compression.write(self.zip, page, rendered)
+
+        bytes_out = 0 if image["duplicate_of"] else self.zip.getinfo(output).compress_size
+        if self.max_bytes and self.max_bytes < bytes_out:
+            self.over_budget += 1
+        steps = result.steps + tuple(timer.steps)
+        wall = sum(step[2] for step in steps)
+        self.tracker.page(image["id"], image["size"], bytes_out, wall)
+        if self.profiler.enabled:
+            self.profiler.add_steps(result.steps, "transcode", pid=result.pid, tid=result.pid)
+            self.profiler.add_steps(timer.steps, "write")
+            self.profiler.add_page(
+                id=image["id"], source=image["source"], bytes_in=image["size"], bytes_out=bytes_out, wall=wall,
+                cpu=sum(step[3] for step in steps), steps={step[0]: step[2] for step in steps},
+            )
+
+    def transcode_input(self, image):
+        """
+        :return: what is given to the transcoder for the image, which is its content if it was read ahead
+        """
+        if self.prefetcher:
+            return self.prefetcher.read(image["source"])
+        return self.source.transcode_input(image["source"])
+
+    def transcode_now(self, image) -> TranscodeResult:
+        """
+        Transcode an image in this thread, for the few images of which it is only known when they are written.
+        """
+        settings = self.transform_settings
+        perceptual = bool(self.dedup and self.dedup.perceptual)
+        if image["tile"]:
+            results = transcode_strip(self.transcode_input(image), image["cuts"], settings, perceptual)
+            return results[image["cuts"].index(image["tile"][0])]
+        if not perceptual and not needs_transform(settings, image["info"], image["crop"]):
+            return TranscodeResult(None, image["width"], image["height"], image["type"])
+        return transcode_image(self.transcode_input(image), settings, perceptual, image["crop"])
+
+    def transcode_images(self):
+        """
+        Yield every image together with its transcode result, in the order of self.images. When multiple jobs are
+        used, the images are transcoded by a process pool while the caller writes the finished images. Results found
+        in the cache, images reused from the ePub that is updated, images that can be copied as-is according to
+        their headers, and images with the same content as an earlier image are not transcoded at all. The pages of a
+        strip are transcoded together by a single job.
+        """
+        settings = self.transform_settings
+        perceptual = bool(self.dedup and self.dedup.perceptual)
+        pending = deque()
+        images = iter(enumerate(self.images))
+        executor = worker_pool(self.jobs) if 1 < self.jobs and not self.shared else None
+        # the source, content, hash, and the future of the results of the strip of the last page of a strip
+        strip = {}
+
+        def strip_input(image):
+            if "input" not in strip:
+                strip["input"] = self.transcode_input(image)
+            return strip["input"]
 
-            if self.wrap_pages:
-                self.zip.writestr(os.path.join("pages", image["id"] + ".xhtml"), template.render(image))
+        def submit_next() -> bool:
+            position, image = next(images, (None, None))
+            if image is None:
+                return False
+            key = None
+            requested = False
+            # whether a job was started for the image, as the later pages of a strip wait for the job of the first
+            job = True
+            if image["tile"] and strip.get("source") != image["source"]:
+                # the pages of a strip follow each other, so only the last strip is kept
+                strip.clear()
+                strip.update(source=image["source"], future=None)
+                if self.dedup:
+                    strip["hash"] = hash_source(strip_input(image))
+            if self.dedup:
+                # a page of a strip has the content of its rows
+                image["content_hash"] = "{}#{}-{}".format(strip["hash"], *image["tile"]) if image["tile"] else \
+                    hash_source(self.transcode_input(image))
+                original_id = self.dedup.find_exact(image["content_hash"], image["id"])
+                # the cover is never replaced by another page, but later pages can be replaced by the cover
+                if original_id and not image["is_cover"]:
+                    image["duplicate_of"] = original_id
+                    image.pop("previous", None)
+            previous_phash = image["previous"].get("phash") if "previous" in image else None
+            if image["duplicate_of"] or ("previous" in image and (not perceptual or previous_phash is not None)) or (
+                    not perceptual and not image["tile"] and
+                    not needs_transform(settings, image["info"], image["crop"])):
+                # the size and type are already known from the ePub that is updated or from the header
+                future = completed_future(
+                    TranscodeResult(None, image["width"], image["height"], image["type"], previous_phash))
+            elif image["tile"]:
+                # a strip is not cached, as it would be hashed for every page
+                if strip["future"] is None:
+                    source = strip_input(image)
+                    strip["future"] = executor.submit(transcode_strip, source, image["cuts"], settings, perceptual) \
+                        if executor else completed_future(transcode_strip(source, image["cuts"], settings, perceptual))
+                else:
+                    job = False
+                future = item_future(strip["future"], image["cuts"].index(image["tile"][0]))
+            else:
+                source = self.transcode_input(image)
+                # the crop of a facing page also depends on the other page
+                key = self.cache.make_key(source, (*settings, image["crop"])) if self.cache else None
+                cached = self.cache.get(key) if key else None
+                if cached and (cached[4] is not None or not perceptual):
+                    future = completed_future(TranscodeResult(*cached))
+                    key = None
+                elif self.shared:
+                    future = self.shared.request(
+                        self.shared_position, position, source, settings, perceptual, image["crop"])
+                    requested = True
+                elif executor:
+                    future = executor.submit(transcode_image, source, settings, perceptual, image["crop"])
+                else:
+                    future = completed_future(transcode_image(source, settings, perceptual, image["crop"]))
+            if self.shared and not requested:
+                # the other makers only wait for the images this one does not need
+                self.shared.request(self.shared_position, position)
+            pending.append((image, key, future, job))
+            return True
 
-            if self.progress:
-                self.progress.progress_set_value(progress)
-            self.check_is_stopped()
-        if self.progress:
-            self.progress.progress_set_value(len(self.images))
+        def submit_ahead():
+            # keep a few images per worker in flight, so the workers never wait for the writer
+            while sum(job for _, _, _, job in pending) < (self.jobs * 2 if executor or self.shared else 1) and \
+                    submit_next():
+                pass
+
+        try:
+            submit_ahead()
+            while pending:
+                image, key, future, _ = pending.popleft()
+                submit_ahead()
+                result = future.result()
+                if key:
+                    self.cache.put(key, result.data, result.width, result.height, result.type, result.phash)
+                yield image, result
+        finally:
+            for _, _, future, _ in pending:
+                future.cancel()
+            if executor:
+                executor.shutdown(wait=True)
 
     def write_template(self, name, *, out=None, data=None):
         out = out or name
+        volume = self.volume
         data = data or {
-            "name": self.name, "uuid": self.uuid, "cover": self.cover, "chapter_tree": self.chapter_tree,
-            "images": self.images, "wrap_pages": self.wrap_pages,
+            "name": volume.name, "uuid": volume.uuid, "cover": volume.cover, "chapter_tree": volume.chapter_tree,
+            "images": volume.images, "wrap_pages": self.wrap_pages,
+            "series": {"name": self.name, "position": volume.number} if self.split else None,
         }
-        self.zip.writestr(out, self.template_env.get_template(name + '.jinja2').render(data))
+        # the templates are streamed into the ePub, so large books are never rendered as a single string
+        with self.profiler.phase("write_" + name):
+            self.compression.write_stream(self.zip, out, self.get_template(name + '.jinja2').generate(data))
+
+    def get_template(self, name):
+        if self.template_env is None:
+            from jinja2 import Environment, FileSystemLoader, StrictUndefined
+
+            self.template_env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), undefined=StrictUndefined)
+        return self.template_env.get_template(name)
 
     def stop(self):
         self.stop_event = True
@@ -256,6 +1420,19 @@ class CmdProgress:
         self.width = 60
         self.maximum = 150
         self.value = 0
+        # the speed and time left of the last page event
+        self.rates = ""
+
+    def progress_event(self, event):
+        if event["event"] == "page":
+            self.rates = format_rates(event)
+        elif event["event"] == "phase" and not self.nice:
+            print(f"Phase: {event['phase']}")
+        elif event["event"] == "done":
+            print(
+                f"{event['pages']} pages in {event['seconds']:.1f}s, {format_size(event['bytes_read'])} read, "
+                f"{format_size(event['bytes_written'])} written"
+            )
 
     def progress_set_value(self, value):
         self.value = value
@@ -268,11 +1445,14 @@ class CmdProgress:
                         done = math.floor(progress / 8)
                         edge = self.edges[int(progress - done * 8)]
 
-                        print('\r│' + '█' * done + edge + ' ' * (self.width - done - 1) + '│ ', end="")
+                        print(
+                            '\r│' + '█' * done + edge + ' ' * (self.width - done - 1) + '│ ' + self.rates.ljust(40),
+                            end=""
+                        )
                     else:
-                        print('\r│' + '█' * self.width + '│')
+                        print('\r│' + '█' * self.width + '│ ' + ' ' * 40)
                 else:
-                    print('At {}/{}'.format(self.value, self.maximum))
+                    print('At {}/{}'.format(self.value, self.maximum) + (f' ({self.rates})' if self.rates else ''))
 
     def progress_set_maximum(self, value):
         self.maximum = value